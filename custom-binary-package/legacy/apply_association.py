@@ -10,7 +10,21 @@ Creation date: 01.24.22 - jshcodes@CrowdStrike
 Requirements: boto3
 """
 from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import time
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+# StartAssociationsOnce accepts at most 10 association IDs per call
+START_BATCH_SIZE = 10
+# Polling starts fast, backs off while nothing changes and resets on progress
+POLL_MIN_SECONDS = 5
+POLL_MAX_SECONDS = 60
+POLL_BACKOFF = 1.5
+FAILED_STATUSES = {"Failed", "TimedOut", "Cancelled"}
+RUNNING_STATUSES = {"Pending", "InProgress"}
 
 
 def parse_command_line() -> object:
@@ -22,39 +36,165 @@ def parse_command_line() -> object:
     parser.add_argument(
         '-r',
         '--region',
-        help='AWS Region where association resides.',
+        help='AWS Region where association resides.\n'
+             'Provide a comma delimited list to re-apply in several regions.',
         required=True
         )
     parser.add_argument(
         '-s',
         '--ssm_doc_name',
-        help='SSM Document Name',
+        help='SSM Document Name\n'
+             'Provide a comma delimited list to re-apply the associations of several documents.',
         required=True
         )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='Number of regions processed concurrently. (Default: 8)',
+        type=int,
+        default=8
+        )
+    parser.add_argument(
+        '--wait',
+        help='Wait for the re-applied associations to finish, reporting progress.',
+        action='store_true'
+        )
+    parser.add_argument(
+        '--timeout',
+        help='Seconds to wait for the associations to finish with --wait. (Default: 1800)',
+        type=int,
+        default=1800
+        )
 
     return parser.parse_args()
 
 
+def list_associations(client, doc_names: list) -> list:
+    """Return every association for the documents, following pagination."""
+    associations = []
+    paginator = client.get_paginator("list_associations")
+    for doc_name in doc_names:
+        for page in paginator.paginate(AssociationFilterList=[{
+            "key": "Name",
+            "value": doc_name
+        }]):
+            associations.extend(page["Associations"])
+    return associations
+
+
+def reapply_region(region: str, doc_names: list) -> dict:
+    """Re-apply every association for the documents in a region."""
+    result = {"region": region, "associations": 0, "request_ids": [], "error": ""}
+    try:
+        ssm_client = CLIENTS[region]
+        assoc_ids = [assoc["AssociationId"] for assoc in list_associations(ssm_client, doc_names)]
+        result["associations"] = len(assoc_ids)
+        result["association_ids"] = set(assoc_ids)
+        for index in range(0, len(assoc_ids), START_BATCH_SIZE):
+            start_result = ssm_client.start_associations_once(
+                AssociationIds=assoc_ids[index:index + START_BATCH_SIZE]
+            )
+            result["request_ids"].append(start_result["ResponseMetadata"]["RequestId"])
+    except (BotoCoreError, ClientError) as err:
+        result["error"] = str(err)
+    return result
+
+
+def region_progress(result: dict, doc_names: list, started: datetime) -> dict:
+    """Aggregate the instance status counts of the associations re-applied in a region.
+
+    A single paginated list_associations call returns the status overview of
+    many associations at once, so no per-association or per-instance describe
+    calls are needed. Associations whose last execution predates the re-apply
+    are counted as pending with the instance count of their previous run.
+    """
+    progress = {"success": 0, "failed": 0, "pending": 0, "complete": True}
+    try:
+        associations = list_associations(CLIENTS[result["region"]], doc_names)
+    except (BotoCoreError, ClientError) as err:
+        print(f"[{result['region']}] Unable to read association status: {err}")
+        progress["complete"] = False
+        return progress
+    for assoc in associations:
+        if assoc["AssociationId"] not in result["association_ids"]:
+            continue
+        overview = assoc.get("Overview", {})
+        counts = overview.get("AssociationStatusAggregatedCount", {})
+        last_run = assoc.get("LastExecutionDate")
+        if last_run is None or last_run < started:
+            progress["pending"] += sum(counts.values())
+            progress["complete"] = False
+            continue
+        if overview.get("Status") == "Pending" or overview.get("DetailedStatus") in RUNNING_STATUSES:
+            progress["complete"] = False
+        for status, count in counts.items():
+            if status == "Success":
+                progress["success"] += count
+            elif status in FAILED_STATUSES:
+                progress["failed"] += count
+            else:
+                progress["pending"] += count
+                progress["complete"] = False
+    return progress
+
+
+def wait_for_rollout(triggered: list, doc_names: list, started: datetime) -> bool:
+    """Poll the re-applied associations until they finish or --timeout expires.
+
+    :return: True if every instance succeeded before the timeout
+    """
+    deadline = time.monotonic() + args.timeout
+    delay = POLL_MIN_SECONDS
+    last_totals = None
+    while True:
+        progress = list(executor.map(lambda res: region_progress(res, doc_names, started), triggered))
+        totals = {key: sum(prog[key] for prog in progress) for key in ("success", "failed", "pending")}
+        complete = sum(prog["complete"] for prog in progress)
+        elapsed = (datetime.now(timezone.utc) - started).total_seconds()
+        print(f"[{elapsed:>6.0f}s] success={totals['success']} failed={totals['failed']} "
+              f"pending={totals['pending']} ({complete}/{len(triggered)} regions complete)")
+        if complete == len(triggered):
+            return totals["failed"] == 0
+        if time.monotonic() + delay > deadline:
+            print(f"Timed out after {args.timeout}s waiting for the associations to finish.")
+            return False
+        delay = POLL_MIN_SECONDS if totals != last_totals else min(delay * POLL_BACKOFF, POLL_MAX_SECONDS)
+        last_totals = totals
+        time.sleep(delay)
+
+
 # Consume inbound command line parameters
 args = parse_command_line()
 
-REGION = args.region
-SSM_DOC_NAME = args.ssm_doc_name
-
-ssm_client = boto3.client("ssm", region_name=REGION)
+REGIONS = [region.strip() for region in args.region.split(",") if region.strip()]
+SSM_DOC_NAMES = [name.strip() for name in args.ssm_doc_name.split(",") if name.strip()]
 
-associations = ssm_client.list_associations(AssociationFilterList=[{
-    "key": "Name",
-    "value": SSM_DOC_NAME
-}])
+# Adaptive retries back off when SSM throttles the concurrent region calls
+CLIENTS = {
+    region: boto3.client("ssm", region_name=region, config=Config(retries={"mode": "adaptive"}))
+    for region in REGIONS
+}
+STARTED = datetime.now(timezone.utc)
 
-assoc_id = associations["Associations"][0]["AssociationId"]
+executor = ThreadPoolExecutor(max_workers=max(args.workers, 1))
+results = list(executor.map(lambda region: reapply_region(region, SSM_DOC_NAMES), REGIONS))
 
-start_result = ssm_client.start_associations_once(AssociationIds=[assoc_id])
+FAILED = False
+for res in results:
+    if res["error"]:
+        FAILED = True
+        print(f"[{res['region']}] Unable to re-apply associations: {res['error']}")
+    elif not res["associations"]:
+        print(f"[{res['region']}] No associations found for {', '.join(SSM_DOC_NAMES)}.")
+    else:
+        print(f"[{res['region']}] Re-applying {res['associations']} association(s) "
+              "to install agent to new instances.\n"
+              f"Request ID(s): {', '.join(res['request_ids'])}")
 
-req_id = start_result["ResponseMetadata"]["RequestId"]
+TRIGGERED = [res for res in results if res["associations"] and not res["error"]]
+if args.wait and TRIGGERED:
+    FAILED = not wait_for_rollout(TRIGGERED, SSM_DOC_NAMES, STARTED) or FAILED
+executor.shutdown()
 
-if start_result["ResponseMetadata"]["HTTPStatusCode"] == 200:
-    print(f"Re-applying association to install agent to new instances.\nRequest ID: {req_id}")
-else:
-    print("Unable to re-apply association.")
+if FAILED:
+    raise SystemExit(1)
@@ -0,0 +1,530 @@
+"""Benchmark the CrowdStrike Distributor package build and publish pipeline.
+
+Generates synthetic sensor payloads and drives the download, hash, build,
+upload and SSM publish stages against an in-memory S3/SSM stand-in and a
+stubbed Falcon API. Every stage is run in serial mode and in parallel mode
+(which also uses the batched catalogue query and multipart uploads). The hash
+stage fingerprints the staged directories as the incremental build does; the
+build stage is DistributorPackager.build, which also zips and hashes the
+archives. Finally create-package.py itself is run end to end over the same
+stubs, serially, in parallel and pipelined. The wall time, throughput and peak
+Python heap usage are reported. The peak heap is measured with tracemalloc in
+this process, so it does not include zip worker processes.
+
+Example:
+    python3 benchmark.py --platforms 20 --payload_size 50 --workers 8
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from botocore.exceptions import ClientError
+from tabulate import tabulate
+
+import packager
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REGIONS = ["us-east-1", "us-west-2", "eu-west-1", "eu-central-1", "ap-southeast-2"]
+BUCKET = "benchmark-bucket"
+PACKAGE_NAME = "CrowdStrike-FalconSensor-Benchmark"
+
+
+def load_create_package():
+    """Import create-package.py, whose file name is not a valid module name."""
+    spec = importlib.util.spec_from_file_location(
+        "create_package", os.path.join(HERE, "create-package.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def satisfying_value(terms):
+    """Build a field value that matches every FQL term applied to that field."""
+    exact = [value for operator, value in terms if operator == "" and "*" not in value]
+    if exact:
+        return exact[0]
+    positives = [value for operator, value in terms if not operator.startswith("!")]
+    return " ".join(value.strip("*") for value in positives)
+
+
+class StubResponse:
+    """Streamed download response serving a payload from disk."""
+
+    status_code = 200
+
+    def __init__(self, path):
+        self.path = path
+
+    def iter_content(self, chunk_size):
+        """Yield the payload in chunks."""
+        with open(self.path, "rb") as file_handle:
+            for chunk in iter(lambda: file_handle.read(chunk_size), b""):
+                yield chunk
+
+    def close(self):
+        """Nothing to release."""
+
+
+class StubFalcon:
+    """Stand-in for falconpy.APIHarness serving synthetic sensor installers."""
+
+    def __init__(self, fql_term, binaries, payloads, latency):
+        self.latency = latency
+        self.payloads = {}
+        self.by_filter = {}
+        self.catalogue = []
+        for binary in binaries:
+            terms = {}
+            for field, operator, value in fql_term.findall(binary["filter"]):
+                terms.setdefault(field, []).append((operator, value))
+            fields = {field: satisfying_value(value) for field, value in terms.items()}
+            sensors = []
+            # Only the N-1 version is downloaded, so the latest version just
+            # needs a unique sha256.
+            latest_sha = hashlib.sha256(binary["path"].encode("utf-8")).hexdigest()
+            previous_sha = packager.sha256_file(payloads[binary["path"]])
+            self.payloads[previous_sha] = payloads[binary["path"]]
+            for version, sha in (("2", latest_sha), ("1", previous_sha)):
+                sensors.append(
+                    {
+                        "name": os.path.basename(binary["path"]),
+                        "os": fields.get("os", ""),
+                        "os_version": fields.get("os_version", ""),
+                        "platform": fields.get("platform", ""),
+                        "version": version,
+                        "sha256": sha,
+                    }
+                )
+            self.by_filter[binary["filter"]] = sensors
+            self.catalogue.extend(sensors)
+        self.catalogue.sort(key=lambda sensor: sensor["version"], reverse=True)
+
+    def command(self, action, **params):
+        """Serve the two Falcon API actions used by create-package.py."""
+        time.sleep(self.latency)
+        if action == "DownloadSensorInstallerById":
+            return StubResponse(self.payloads[params["id"]])
+        if "filter" in params:
+            resources = self.by_filter[params["filter"]]
+        else:
+            offset = params.get("offset", 0)
+            resources = self.catalogue[offset:offset + params.get("limit", 500)]
+        return {
+            "status_code": 200,
+            "body": {
+                "resources": resources,
+                "meta": {"pagination": {"total": len(self.catalogue)}},
+            },
+        }
+
+
+class FakeS3:
+    """In-memory stand-in for the S3 client calls made by packager.py."""
+
+    def __init__(self, buckets, latency):
+        self.buckets = buckets
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def head_bucket(self, Bucket):  # pylint: disable=C0103
+        """Probe a bucket."""
+        time.sleep(self.latency)
+        if Bucket not in self.buckets:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadBucket")
+
+    def create_bucket(self, Bucket, **_):  # pylint: disable=C0103
+        """Create a bucket."""
+        time.sleep(self.latency)
+        with self._lock:
+            self.buckets.setdefault(Bucket, {})
+
+    def put_object(self, Bucket, Key, Body, Metadata=None):  # pylint: disable=C0103
+        """Store an object, draining the body in chunks."""
+        size = sum(len(chunk) for chunk in iter(lambda: Body.read(packager.MB), b""))
+        time.sleep(self.latency)
+        self.buckets[Bucket][Key] = {"Size": size, "Metadata": Metadata or {}}
+
+    def upload_file(  # pylint: disable=C0103, R0913
+        self, Filename, Bucket, Key, ExtraArgs=None, Config=None
+    ):
+        """Store an object, charging one round trip per batch of concurrent parts."""
+        size = os.path.getsize(Filename)
+        with open(Filename, "rb") as file_handle:
+            for _ in iter(lambda: file_handle.read(packager.MB), b""):
+                pass
+        parts = max(math.ceil(size / Config.multipart_chunksize), 1)
+        time.sleep(self.latency * math.ceil(parts / Config.max_concurrency))
+        metadata = (ExtraArgs or {}).get("Metadata", {})
+        self.buckets[Bucket][Key] = {"Size": size, "Metadata": metadata}
+
+    def copy(  # pylint: disable=R0913
+        self, CopySource, Bucket, Key, ExtraArgs=None, SourceClient=None, Config=None  # pylint: disable=C0103
+    ):
+        """Copy an object server side."""
+        del SourceClient, Config
+        time.sleep(self.latency)
+        source = self.buckets[CopySource["Bucket"]][CopySource["Key"]]
+        metadata = (ExtraArgs or {}).get("Metadata", source["Metadata"])
+        self.buckets[Bucket][Key] = {"Size": source["Size"], "Metadata": metadata}
+
+    def head_object(self, Bucket, Key):  # pylint: disable=C0103
+        """Return an object's metadata."""
+        time.sleep(self.latency)
+        return {"Metadata": self.buckets[Bucket][Key]["Metadata"]}
+
+    def get_paginator(self, _):
+        """Return a list_objects_v2 paginator."""
+        fake = self
+
+        class Paginator:  # pylint: disable=R0903
+            """Single page list_objects_v2 paginator."""
+
+            @staticmethod
+            def paginate(Bucket, Prefix):  # pylint: disable=C0103
+                """Yield the objects under a prefix."""
+                time.sleep(fake.latency)
+                yield {
+                    "Contents": [
+                        {"Key": key, "Size": obj["Size"]}
+                        for key, obj in fake.buckets.get(Bucket, {}).items()
+                        if key.startswith(Prefix)
+                    ]
+                }
+
+        return Paginator()
+
+
+class FakeSSM:
+    """In-memory stand-in for the SSM client calls made by packager.py."""
+
+    class exceptions:  # pylint: disable=C0103, R0903
+        """Modeled SSM exceptions."""
+
+        class InvalidDocument(Exception):
+            """The document does not exist."""
+
+        class DuplicateDocumentContent(Exception):
+            """The content matches the latest version."""
+
+        class DocumentVersionLimitExceeded(Exception):
+            """Too many document versions."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.documents = {}
+
+    def get_document(self, Name):  # pylint: disable=C0103
+        """Return the default version of a document."""
+        time.sleep(self.latency)
+        if Name not in self.documents:
+            raise self.exceptions.InvalidDocument(Name)
+        document = self.documents[Name]
+        return {"Name": Name, "Content": document["versions"][document["default"]]}
+
+    def create_document(self, Name, Content, Tags=(), **_):  # pylint: disable=C0103
+        """Create a document."""
+        time.sleep(self.latency)
+        self.documents[Name] = {"versions": {"1": Content}, "default": "1", "tags": {}}
+        self.add_tags_to_resource("Document", Name, Tags)
+
+    def list_tags_for_resource(self, ResourceType, ResourceId):  # pylint: disable=C0103
+        """Return the tags of a document."""
+        del ResourceType
+        time.sleep(self.latency)
+        tags = self.documents[ResourceId]["tags"]
+        return {"TagList": [{"Key": key, "Value": value} for key, value in tags.items()]}
+
+    def add_tags_to_resource(self, ResourceType, ResourceId, Tags):  # pylint: disable=C0103
+        """Add or overwrite tags of a document."""
+        del ResourceType
+        self.documents[ResourceId]["tags"].update({tag["Key"]: tag["Value"] for tag in Tags})
+
+    def update_document(self, Name, Content, **_):  # pylint: disable=C0103
+        """Add a new document version."""
+        time.sleep(self.latency)
+        versions = self.documents[Name]["versions"]
+        if versions[max(versions, key=int)] == Content:
+            raise self.exceptions.DuplicateDocumentContent(Name)
+        version = str(max(int(key) for key in versions) + 1)
+        versions[version] = Content
+        return {"DocumentDescription": {"DocumentVersion": version}}
+
+    def update_document_default_version(self, Name, DocumentVersion):  # pylint: disable=C0103
+        """Set the default document version."""
+        time.sleep(self.latency)
+        self.documents[Name]["default"] = DocumentVersion
+
+    def delete_document(self, Name, DocumentVersion):  # pylint: disable=C0103
+        """Delete a document version."""
+        time.sleep(self.latency)
+        del self.documents[Name]["versions"][DocumentVersion]
+
+    def get_paginator(self, _):
+        """Return a list_document_versions paginator."""
+        fake = self
+
+        class Paginator:  # pylint: disable=R0903
+            """Single page list_document_versions paginator."""
+
+            @staticmethod
+            def paginate(Name):  # pylint: disable=C0103
+                """Yield the versions of a document."""
+                time.sleep(fake.latency)
+                document = fake.documents[Name]
+                yield {
+                    "DocumentVersions": [
+                        {"DocumentVersion": key, "IsDefaultVersion": key == document["default"]}
+                        for key in document["versions"]
+                    ]
+                }
+
+        return Paginator()
+
+
+def measure(results, stage, mode, func, total_bytes=None):
+    """
+    Run a stage and record its wall time, throughput and peak Python heap
+    :param results: List the measurement is appended to
+    :param stage: Name of the pipeline stage
+    :param mode: serial or parallel
+    :param func: Callable running the stage; may return the bytes processed
+    :param total_bytes: Bytes processed, if func does not return them
+    """
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    returned = func()
+    seconds = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    total_bytes = total_bytes if total_bytes is not None else returned or 0
+    results.append(
+        {
+            "stage": stage,
+            "mode": mode,
+            "seconds": round(seconds, 3),
+            "mb": round(total_bytes / packager.MB, 1),
+            "mb_per_s": round(total_bytes / packager.MB / max(seconds, 1e-9), 1),
+            "peak_mb": round(peak / packager.MB, 1),
+        }
+    )
+
+
+def generate_payloads(binaries, payload_size, directory):
+    """Write an incompressible synthetic installer for every binary."""
+    payloads = {}
+    os.makedirs(directory, exist_ok=True)
+    for index, binary in enumerate(binaries):
+        path = os.path.join(directory, f"{index}-{os.path.basename(binary['path'])}")
+        with open(path, "wb") as file_handle:
+            for _ in range(payload_size):
+                file_handle.write(os.urandom(packager.MB))
+        payloads[binary["path"]] = path
+    return payloads
+
+
+def end_to_end_modes(args):
+    """Return the create-package.py command line of every end-to-end run."""
+    argv = [
+        "--aws_region",
+        ",".join(REGIONS[: args.regions]),
+        "--s3bucket",
+        BUCKET,
+        "--package_name",
+        PACKAGE_NAME,
+        "--compression",
+        args.compression,
+    ]
+    workers = str(args.workers)
+    parallel = argv + [
+        "--download_workers",
+        workers,
+        "--batch_query",
+        "--zip_workers",
+        workers,
+        "--multipart_upload",
+        "--upload_workers",
+        workers,
+        "--region_workers",
+        workers,
+    ]
+    return {"serial": argv, "parallel": parallel, "pipelined": parallel + ["--pipeline"]}
+
+
+def run(args):  # pylint: disable=R0914
+    """Run every stage of the pipeline in serial and parallel mode."""
+    create_package = load_create_package()
+    binaries = create_package.binary_list[: args.platforms]
+    dirs = {os.path.dirname(binary["path"]) for binary in binaries}
+    with open(os.path.join(HERE, "agent_list.json"), "rb") as file_handle:
+        mappings = json.load(file_handle)
+    mappings = {
+        os_type: [entry for entry in entries if entry["dir"] in dirs]
+        for os_type, entries in mappings.items()
+    }
+
+    workspace = tempfile.mkdtemp(prefix="distributor-benchmark-")
+    cwd = os.getcwd()
+    results = []
+    try:
+        os.chdir(workspace)
+        shutil.copytree(os.path.join(HERE, "scripts"), "scripts")
+        with open("agent_list.json", "w", encoding="utf-8") as file_handle:
+            json.dump(mappings, file_handle)
+        payloads = generate_payloads(binaries, args.payload_size, "payloads")
+        payload_bytes = sum(os.path.getsize(path) for path in payloads.values())
+        falcon = StubFalcon(
+            create_package.FQL_TERM, binaries, payloads, args.api_latency / 1000
+        )
+        buckets = {}
+        for region in REGIONS[: args.regions]:
+            packager._clients[("s3", region)] = FakeS3(  # pylint: disable=W0212
+                buckets, args.aws_latency / 1000
+            )
+            packager._clients[("ssm", region)] = FakeSSM(  # pylint: disable=W0212
+                args.aws_latency / 1000
+            )
+        os.makedirs(packager.PATH_TO_BUCKET_FOLDER, exist_ok=True)
+
+        for mode, workers in (("serial", 1), ("parallel", args.workers)):
+            downloader = create_package.SensorDownloader(falcon)
+
+            def download():
+                # The parallel run also uses the batched catalogue query
+                if workers > 1:
+                    downloader.sensor_index = create_package.SensorIndex(
+                        downloader.fetch_catalogue()
+                    )
+                downloader.download_all(binaries, workers)
+
+            measure(results, "download", mode, download, payload_bytes)
+            measure(
+                results,
+                "hash",
+                mode,
+                lambda: sum(
+                    packager.DistributorPackager._hash_directory(directory)[1]  # pylint: disable=W0212
+                    for directory in sorted(dirs)
+                ),
+            )
+            builder = packager.DistributorPackager(
+                zip_workers=workers, compression=args.compression
+            )
+            measure(results, "build", mode, lambda: builder.build("agent_list.json"), payload_bytes)
+            archives = sorted(builder.checksums)
+            archive_bytes = sum(
+                os.path.getsize(packager.PATH_TO_BUCKET_FOLDER + file) for file in archives
+            )
+            updater = packager.S3BucketUpdater(
+                REGIONS[0], multipart=workers > 1, upload_workers=workers
+            )
+            buckets.clear()
+            measure(
+                results,
+                "upload",
+                mode,
+                lambda: updater.update(BUCKET, archives, "falcon/", builder.checksums),
+                archive_bytes,
+            )
+            for region in REGIONS[: args.regions]:
+                packager._clients[("ssm", region)].documents.clear()  # pylint: disable=W0212
+            measure(
+                results,
+                "ssm publish",
+                mode,
+                lambda: packager.publish_package(
+                    PACKAGE_NAME,
+                    {region: BUCKET for region in REGIONS[: args.regions]},
+                    packager.PATH_TO_BUCKET_FOLDER + "manifest.json",
+                    workers=workers,
+                ),
+                0,
+            )
+            for directory in dirs:
+                shutil.rmtree(directory)
+
+        create_package.binary_list = binaries
+        create_package.load_api_harness = lambda: lambda **_: falcon
+        # main() insists on credentials even though the stub ignores them
+        os.environ.setdefault("FALCON_CLIENT_ID", "benchmark")
+        os.environ.setdefault("FALCON_CLIENT_SECRET", "benchmark")
+        for mode, argv in end_to_end_modes(args).items():
+            buckets.clear()
+            for region in REGIONS[: args.regions]:
+                packager._clients[("ssm", region)].documents.clear()  # pylint: disable=W0212
+            measure(
+                results, "end-to-end", mode, lambda: create_package.main(argv), payload_bytes
+            )
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument(
+        "--platforms",
+        type=int,
+        help="The number of binary_list platforms to build.",
+        default=20,
+    )
+    parser.add_argument(
+        "--payload_size",
+        type=int,
+        help="The size of each synthetic sensor installer in MB.",
+        default=20,
+    )
+    parser.add_argument(
+        "--regions",
+        type=int,
+        choices=range(1, len(REGIONS) + 1),
+        help="The number of regions to publish to.",
+        default=3,
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="The worker count used for the parallel runs.",
+        default=os.cpu_count() or 4,
+    )
+    parser.add_argument(
+        "--compression",
+        choices=packager.COMPRESSION_MODES,
+        help="The archive compression policy.",
+        default="deflate",
+    )
+    parser.add_argument(
+        "--api_latency",
+        type=float,
+        help="Simulated Falcon API round trip latency in ms.",
+        default=50,
+    )
+    parser.add_argument(
+        "--aws_latency",
+        type=float,
+        help="Simulated AWS API round trip latency in ms.",
+        default=30,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Write the results as JSON to this file.",
+    )
+
+    args = parser.parse_args()
+
+    results = run(args)
+    print(tabulate(results, headers="keys"))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
@@ -1,61 +1,170 @@
 import argparse
-from genericpath import exists
+import fnmatch
+import hashlib
+import json
 import os
-from re import split
-import resource
+import random
+import re
 import shutil
-import subprocess
-from urllib.request import urlretrieve
-
-try:
-    from falconpy import APIHarness
-except ImportError as no_falconpy:
-    raise SystemExit(
-        "The CrowdStrike SDK must be installed in order to use this utility.\n"
-        "Install this application with the command `python3 -m pip install crowdstrike-falconpy`."
-    ) from no_falconpy
-
-parser = argparse.ArgumentParser(
-    prog="create-package",
-    description="Create a ssm distributor package that contains Falcon Sensor binaries",
-)
-
-parser.add_argument(
-    "-r",
-    "--aws_region",
-    required=True,
-    help="The aws region to create the ssm distributor package in.",
-)
-parser.add_argument(
-    "-b",
-    "--s3bucket",
-    required=True,
-    help="The name of the s3 bucket to upload the required files to.",
-)
-parser.add_argument(
-    "-p",
-    "--package_name",
-    help="The name of the distributor package to create.",
-    default="CrowdStrike-FalconSensor",
-)
-
-args = parser.parse_args()
-
-client_id = os.environ.get("FALCON_CLIENT_ID")
-client_secret = os.environ.get("FALCON_CLIENT_SECRET")
-
-if not client_id:
-    raise ValueError("FALCON_CLIENT_ID environment variable not set.")
-
-if not client_secret:
-    raise ValueError("FALCON_CLIENT_SECRET environment variable not set.")
-
-dirs_to_delete = []
-
-python_executable = shutil.which("python3")
-
-if not python_executable:
-    python_executable = "python"
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrumentation
+import journal
+import packager
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+CATALOGUE_PAGE_SIZE = 500
+FQL_TERM = re.compile(r"(\w+):(!?~?)'([^']*)'")
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+SENSOR_VERSION = re.compile(r"n(?:-(\d+))?")
+
+
+def load_api_harness():
+    """Import falconpy on first use so --help starts without loading the SDK."""
+    try:
+        from falconpy import APIHarness  # pylint: disable=C0415
+    except ImportError as no_falconpy:
+        raise SystemExit(
+            "The CrowdStrike SDK must be installed in order to use this utility.\n"
+            "Install this application with the command `python3 -m pip install crowdstrike-falconpy`."
+        ) from no_falconpy
+    return APIHarness
+
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, falling back to a copy across filesystems."""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class SensorCache:
+    """Content-addressed on-disk cache of sensor installers keyed by sha256.
+
+    Entries are evicted least recently used first once the cache grows past
+    max_bytes. A cache hit refreshes the entry's mtime, which is used as the
+    LRU clock so recency survives between runs.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def fetch(self, sha, dest):
+        """Place the cached installer for sha at dest.
+
+        The installer is verified against sha before it is used; an entry
+        that was truncated or modified is evicted and treated as a miss.
+
+        :param sha: The sensor sha256
+        :param dest: Path to link or copy the installer to
+        :return: True on a cache hit, else False
+        """
+        entry = os.path.join(self.cache_dir, sha)
+        with self._lock:
+            if not os.path.isfile(entry):
+                return False
+            os.utime(entry)
+            link_or_copy(entry, dest)
+        if packager.sha256_file(dest) == sha:
+            return True
+        print(f"Evicting corrupt cache entry {entry}")
+        os.remove(dest)
+        with self._lock:
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+        return False
+
+    def store(self, sha, src):
+        """Add a downloaded installer to the cache and enforce the size cap."""
+        entry = os.path.join(self.cache_dir, sha)
+        partial = f"{entry}.{threading.get_ident()}.partial"
+        link_or_copy(src, partial)
+        with self._lock:
+            os.replace(partial, entry)
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".partial"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+
+class SensorIndex:
+    """In-memory index of the sensor installer catalogue.
+
+    Installers are grouped by (os, os_version, platform) and resolved against
+    the subset of FQL used by binary_list locally, so the catalogue only has
+    to be fetched once. Exact-match terms are looked up in a per-field index;
+    only wildcard, contains and negated terms are evaluated against each
+    remaining group. The catalogue is expected in version.desc order and that
+    order is preserved within every resolved result.
+    """
+
+    FIELDS = ("os", "os_version", "platform")
+
+    def __init__(self, sensors):
+        self._groups = {}
+        self._keys = {field: {} for field in self.FIELDS}
+        for position, sensor in enumerate(sensors):
+            key = tuple(sensor.get(field, "") for field in self.FIELDS)
+            if key not in self._groups:
+                for field, value in zip(self.FIELDS, key):
+                    self._keys[field].setdefault(value.lower(), set()).add(key)
+            self._groups.setdefault(key, []).append((position, sensor))
+
+    def resolve(self, fql_filter):
+        """Return the sensors matching an FQL filter, newest version first."""
+        keys = None
+        scanned_terms = []
+        for field, operator, value in FQL_TERM.findall(fql_filter):
+            if operator == "" and field in self._keys and not any(char in value for char in "*?["):
+                found = self._keys[field].get(value.lower(), set())
+                keys = found if keys is None else keys & found
+            else:
+                scanned_terms.append((field, operator, value))
+        matches = []
+        for key in self._groups if keys is None else keys:
+            fields = dict(zip(self.FIELDS, key))
+            if all(
+                self._match(fields.get(field, ""), operator, value)
+                for field, operator, value in scanned_terms
+            ):
+                matches.extend(self._groups[key])
+        return [sensor for _, sensor in sorted(matches, key=lambda match: match[0])]
+
+    @staticmethod
+    def _match(field_value, operator, value):
+        """Evaluate a single FQL comparison."""
+        field_value = field_value.lower()
+        value = value.lower()
+        if operator.endswith("~"):
+            matched = value in field_value
+        else:
+            matched = fnmatch.fnmatchcase(field_value, value)
+        return not matched if operator.startswith("!") else matched
+
 
 binary_list = [
     {
@@ -160,91 +269,695 @@ binary_list = [
     },
 ]
 
-falcon = APIHarness(
-    client_id=os.environ.get("FALCON_CLIENT_ID"),
-    client_secret=os.environ.get("FALCON_CLIENT_SECRET"),
-)
 
-print("Downloading required files...")
+def save_sensor(download, path, sha, sensor_name):
+    """Write a sensor download to disk in chunks, verifying its sha256 as it streams.
 
-for binary in binary_list:
-    sensors = falcon.command(
-        action="GetCombinedSensorInstallersByQuery",
-        filter=binary["filter"],
-        sort="version.desc",
-    )
+    :param download: A streamed requests response, or the installer bytes
+    :param path: Destination path of the installer
+    :param sha: The expected sha256 returned by the sensor query
+    :param sensor_name: Sensor name used in error messages
+    """
+    if isinstance(download, (bytes, bytearray)):
+        chunks = [download]
+    else:
+        if download.status_code != 200:
+            raise SystemExit(
+                f"API error while downloading sensor {sensor_name}. "
+                f"Status code: {download.status_code}"
+            )
+        chunks = download.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
 
-    if not isinstance(sensors, dict):
-        raise SystemExit(
-            f"API call failed for filter: {binary['filter']}. "
-            f"Expected dict response, got {type(sensors).__name__}."
-        )
+    digest = hashlib.sha256()
+    partial = f"{path}.partial"
+    try:
+        with open(partial, "wb") as save_file:
+            for chunk in chunks:
+                digest.update(chunk)
+                save_file.write(chunk)
+    finally:
+        if hasattr(download, "close"):
+            download.close()
 
-    if sensors.get("status_code") != 200:
-        error_msg = sensors.get("body", {}).get("errors", [{}])[0].get("message", "Unknown error")
+    if digest.hexdigest() != sha:
+        os.remove(partial)
         raise SystemExit(
-            f"API error while querying sensors for filter: {binary['filter']}. "
-            f"Status code: {sensors.get('status_code')}, Error: {error_msg}"
+            f"Checksum mismatch for sensor {sensor_name}. "
+            f"Expected {sha}, got {digest.hexdigest()}."
         )
+    os.replace(partial, path)
 
-    if "body" not in sensors:
-        raise SystemExit(
-            f"API response missing 'body' for filter: {binary['filter']}. "
-            f"Full response: {sensors}"
-        )
 
-    resources = sensors["body"].get("resources", [])
-    if len(resources) == 0:
-        raise SystemExit(
-            f"Unable to find sensor that matches filter: {binary['filter']}"
-        )
-    if len(resources) > 1:
-        sensor = resources[1]
-    else:
-        sensor = resources[0]
+def select_sensor(resources, sensor_version="n-1"):
+    """Pick a sensor from query results sorted by version.desc.
 
-    sha = sensor["sha256"]
-    sensor_os = sensor["os"]
-    sensor_os_version = sensor["os_version"]
-    sensor_name = sensor["name"]
+    :param resources: The sensors matching a binary_list filter, newest first
+    :param sensor_version: "n" for the latest sensor, "n-1", "n-2", ... for an
+        older release, or a version prefix such as "7.10" to pin a version
+    :return: The selected sensor, or None if no sensor matches sensor_version
+    """
+    relative = SENSOR_VERSION.fullmatch(sensor_version.lower())
+    if relative:
+        # Fall back to the oldest available sensor, as N-1 always has
+        return resources[min(int(relative.group(1) or 0), len(resources) - 1)]
+    for sensor in resources:
+        if sensor["version"].startswith(sensor_version):
+            return sensor
+    return None
 
-    print(f"Downloading {sensor_name} for {sensor_os} {sensor_os_version}")
 
-    download = falcon.command(action="DownloadSensorInstallerById", id=sha)
+class RateLimitedFalcon:
+    """Wrap an APIHarness so the query and download calls share one rate limiter.
 
-    if not download:
-        raise SystemExit(
-            f"Failed to download sensor {sensor_name}. The download returned empty content."
-        )
+    Requests are paced by a token bucket whose rate and level follow the
+    X-RateLimit-Limit (per minute) and X-RateLimit-Remaining response headers.
+    Throttled and failed requests are retried with jittered exponential
+    backoff, honouring X-RateLimit-RetryAfter, and every worker pauses until
+    the throttle has passed.
+    """
 
-    if isinstance(download, dict):
-        error_msg = download.get("body", {}).get("errors", [{}])[0].get("message", "Unknown error")
-        raise SystemExit(
-            f"API error while downloading sensor {sensor_name}. "
-            f"Status code: {download.get('status_code')}, Error: {error_msg}"
+    def __init__(self, falcon, max_retries=5):
+        self.falcon = falcon
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._limit = None
+        self._tokens = 0.0
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+
+    def command(self, *args, **kwargs):
+        """Run an APIHarness command, retrying throttled and failed requests.
+
+        :return: The last response, which may still be an error once the
+            retries are exhausted
+        """
+        stage = "download" if kwargs.get("action") == "DownloadSensorInstallerById" else "query"
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            response = self.falcon.command(*args, **kwargs)
+            if isinstance(response, dict):
+                status = response.get("status_code")
+                headers = response.get("headers") or {}
+            else:
+                status = getattr(response, "status_code", 200)
+                headers = getattr(response, "headers", None) or {}
+            headers = {key.lower(): value for key, value in headers.items()}
+            self._observe(headers)
+            if status not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+
+            delay = self._backoff(attempt, headers)
+            print(
+                f"Falcon API returned {status} for {kwargs.get('action')}, "
+                f"retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})"
+            )
+            instrumentation.add_retries(stage)
+            if hasattr(response, "close"):
+                response.close()
+            time.sleep(delay)
+        return response
+
+    def _acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0 and self._limit:
+                    rate = self._limit / 60
+                    self._tokens = min(
+                        self._limit, self._tokens + (now - self._refilled) * rate
+                    )
+                    self._refilled = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / rate
+                elif wait <= 0:
+                    return
+            time.sleep(wait)
+
+    def _observe(self, headers):
+        """Resynchronise the token bucket with the rate-limit headers of a response."""
+        try:
+            limit = int(headers["x-ratelimit-limit"])
+            remaining = int(headers["x-ratelimit-remaining"])
+        except (KeyError, ValueError):
+            return
+        with self._lock:
+            if self._limit is None:
+                self._refilled = time.monotonic()
+                self._tokens = remaining
+            self._limit = limit
+            self._tokens = min(self._tokens, remaining)
+
+    def _backoff(self, attempt, headers):
+        """Return the delay before a retry and pause the other workers for as long."""
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+        try:
+            delay = max(delay, float(headers["x-ratelimit-retryafter"]) - time.time())
+        except (KeyError, ValueError):
+            pass
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+
+class SensorDownloader:
+    """Class to download and stage the sensors listed in binary_list."""
+
+    def __init__(self, falcon, sensor_cache=None, sensor_index=None):
+        self.falcon = falcon
+        self.sensor_cache = sensor_cache
+        self.sensor_index = sensor_index
+        self._resolved = {}
+
+    def query_sensors(self, description, **params):
+        """Run a GetCombinedSensorInstallersByQuery request.
+
+        :param description: What is being queried, used in error messages
+        :param params: Query parameters passed through to the API
+        :return: Dictionary with the response resources and pagination metadata
+        """
+        with instrumentation.span("query", description=description):
+            sensors = self.falcon.command(action="GetCombinedSensorInstallersByQuery", **params)
+
+        if not isinstance(sensors, dict):
+            raise SystemExit(
+                f"API call failed for {description}. "
+                f"Expected dict response, got {type(sensors).__name__}."
+            )
+
+        if sensors.get("status_code") != 200:
+            error_msg = sensors.get("body", {}).get("errors", [{}])[0].get("message", "Unknown error")
+            raise SystemExit(
+                f"API error while querying sensors for {description}. "
+                f"Status code: {sensors.get('status_code')}, Error: {error_msg}"
+            )
+
+        if "body" not in sensors:
+            raise SystemExit(
+                f"API response missing 'body' for {description}. "
+                f"Full response: {sensors}"
+            )
+
+        return {
+            "resources": sensors["body"].get("resources", []),
+            "pagination": sensors["body"].get("meta", {}).get("pagination", {}),
+        }
+
+    def fetch_catalogue(self):
+        """Fetch every sensor installer, newest version first, following pagination."""
+        catalogue = []
+        while True:
+            page = self.query_sensors(
+                "the sensor installer catalogue",
+                sort="version.desc",
+                offset=len(catalogue),
+                limit=CATALOGUE_PAGE_SIZE,
+            )
+            catalogue.extend(page["resources"])
+            total = page["pagination"].get("total", 0)
+            if not page["resources"] or len(catalogue) >= total:
+                return catalogue
+
+    def resolve(self, binary):
+        """Return the sensor a binary_list entry selects.
+
+        Query results are kept per filter, so packages built from the same
+        binary_list only query each filter once.
+
+        :param binary: A binary_list entry, optionally with a "sensor_version"
+            (see select_sensor); defaults to the N-1 sensor
+        :return: The selected sensor
+        """
+        resources = self._resolved.get(binary["filter"])
+        if resources is None:
+            if self.sensor_index:
+                resources = self.sensor_index.resolve(binary["filter"])
+            else:
+                resources = self.query_sensors(
+                    f"filter: {binary['filter']}",
+                    filter=binary["filter"],
+                    sort="version.desc",
+                )["resources"]
+            self._resolved[binary["filter"]] = resources
+        if len(resources) == 0:
+            raise SystemExit(
+                f"Unable to find sensor that matches filter: {binary['filter']}"
+            )
+        sensor_version = binary.get("sensor_version", "n-1")
+        sensor = select_sensor(resources, sensor_version)
+        if sensor is None:
+            raise SystemExit(
+                f"Unable to find sensor version {sensor_version} that matches filter: {binary['filter']}"
+            )
+        return sensor
+
+    def download(self, binary):
+        """Download the sensor selected by a binary_list entry into its staging directory.
+
+        :param binary: A binary_list entry
+        :return: The staging directory the sensor was written to
+        """
+        sensor = self.resolve(binary)
+
+        sha = sensor["sha256"]
+        sensor_os = sensor["os"]
+        sensor_os_version = sensor["os_version"]
+        sensor_name = sensor["name"]
+
+        os_dir = os.path.dirname(binary["path"])
+        os.makedirs(os_dir, exist_ok=True)
+
+        with instrumentation.span("download", path=binary["path"]) as span:
+            # A resumed run reuses installers its journal records, once verified
+            span["resumed"] = (
+                journal.completed("download", binary["path"], sha)
+                and os.path.isfile(binary["path"])
+                and packager.sha256_file(binary["path"]) == sha
+            )
+            span["cached"] = not span["resumed"] and bool(
+                self.sensor_cache and self.sensor_cache.fetch(sha, binary["path"])
+            )
+            if span["resumed"]:
+                print(f"Resuming with downloaded {sensor_name} for {sensor_os} {sensor_os_version}")
+            elif span["cached"]:
+                print(f"Using cached {sensor_name} for {sensor_os} {sensor_os_version}")
+            else:
+                print(f"Downloading {sensor_name} for {sensor_os} {sensor_os_version}")
+
+                download = self.falcon.command(
+                    action="DownloadSensorInstallerById", id=sha, stream=True
+                )
+
+                if download is None or download == b"":
+                    raise SystemExit(
+                        f"Failed to download sensor {sensor_name}. The download returned empty content."
+                    )
+
+                if isinstance(download, dict):
+                    error_msg = download.get("body", {}).get("errors", [{}])[0].get("message", "Unknown error")
+                    raise SystemExit(
+                        f"API error while downloading sensor {sensor_name}. "
+                        f"Status code: {download.get('status_code')}, Error: {error_msg}"
+                    )
+
+                save_sensor(download, binary["path"], sha, sensor_name)
+                if self.sensor_cache:
+                    self.sensor_cache.store(sha, binary["path"])
+            span["bytes"] = os.path.getsize(binary["path"])
+            journal.record("download", binary["path"], sha256=sha)
+
+        return self._stage_scripts(binary)
+
+    def stage_from(self, binary, installer):
+        """Stage a binary_list entry from an installer downloaded for another entry.
+
+        :param binary: A binary_list entry
+        :param installer: Path to an installer with the sha256 binary selects
+        :return: The staging directory the sensor was linked or copied to
+        """
+        os.makedirs(os.path.dirname(binary["path"]), exist_ok=True)
+        link_or_copy(installer, binary["path"])
+        return self._stage_scripts(binary)
+
+    @staticmethod
+    def _stage_scripts(binary):
+        """Copy the install scripts of a binary_list entry into its staging directory."""
+        os_dir = os.path.dirname(binary["path"])
+        shutil.copytree(
+            f"./scripts/{binary['installer']}", f"{os_dir}/", dirs_exist_ok=True
         )
+        return os_dir
+
+    def download_all(self, binaries, workers=1):
+        """Download binaries on a bounded thread pool, failing fast on the first error.
+
+        :param binaries: binary_list entries to download
+        :param workers: The number of sensors downloaded concurrently
+        :return: The staging directories the sensors were written to
+        """
+        return list(self.iter_downloads(binaries, workers))
+
+    def iter_downloads(self, binaries, workers=1):
+        """Download binaries on a bounded thread pool, yielding each staging directory as it completes.
+
+        :param binaries: binary_list entries to download
+        :param workers: The number of sensors downloaded concurrently
+        :return: A generator of the staging directories the sensors were written to
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.download, binary) for binary in binaries]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            except BaseException:
+                # Fail fast: drop any queued downloads and let in-flight ones finish.
+                for future in futures:
+                    future.cancel()
+                raise
+        journal.sync()
 
-    os_dir = os.path.dirname(binary["path"])
-    os.makedirs(os_dir, exist_ok=True)
-    with open(binary["path"], "wb") as save_file:
-        save_file.write(download)
-    shutil.copytree(
-        f"./scripts/{binary['installer']}", f"{os_dir}/", dirs_exist_ok=True
+
+def parse_command_line(argv=None):
+    """Parse the command line for inbound configuration parameters.
+
+    :param argv: Arguments to parse instead of sys.argv
+    """
+    parser = argparse.ArgumentParser(
+        prog="create-package",
+        description="Create a ssm distributor package that contains Falcon Sensor binaries",
     )
-    dirs_to_delete.append(os_dir)
 
-subprocess.check_call(
-    [
-        "python3",
-        "packager.py",
+    parser.add_argument(
         "-r",
-        args.aws_region,
+        "--aws_region",
+        dest="aws_regions",
+        metavar="AWS_REGION",
+        required=True,
+        help="The aws region to create the ssm distributor package in.",
+    )
+    parser.add_argument(
         "-b",
-        args.s3bucket,
+        "--s3bucket",
+        required=True,
+        help="The name of the s3 bucket to upload the required files to.",
+    )
+    parser.add_argument(
         "-p",
-        args.package_name,
-    ]
-)
-for d in dirs_to_delete:
-    shutil.rmtree(d)
-print(f"Package {args.package_name} created successfully in region {args.aws_region}.")
+        "--package_name",
+        help="The name of the distributor package to create.",
+        default="CrowdStrike-FalconSensor",
+    )
+    parser.add_argument(
+        "--download_workers",
+        type=int,
+        help="The number of sensor installers to download concurrently.",
+        default=1,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory used to cache sensor installers between runs. Caching is disabled if not set.",
+    )
+    parser.add_argument(
+        "--cache_max_size",
+        type=int,
+        help="The maximum size of the sensor installer cache in MB.",
+        default=2048,
+    )
+    parser.add_argument(
+        "--api_retries",
+        type=int,
+        help="The number of times a throttled or failed CrowdStrike API request is retried.",
+        default=5,
+    )
+    parser.add_argument(
+        "--batch_query",
+        action="store_true",
+        help="Fetch the sensor installer catalogue once and resolve every filter locally.",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Zip, hash and upload each platform as soon as its sensor is downloaded.",
+    )
+    parser.add_argument(
+        "--packages",
+        help="JSON file listing several packages to build and publish from shared downloads.",
+    )
+    packager.add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    if args.download_workers < 1:
+        parser.error("--download_workers must be at least 1.")
+
+    if args.api_retries < 0:
+        parser.error("--api_retries must not be negative.")
+
+    if args.packages and args.pipeline:
+        parser.error("--packages can not be combined with --pipeline.")
+
+    return args
+
+
+def build_pipelined(downloader, args):
+    """Download, zip, hash and upload every platform as soon as its input is ready.
+
+    Only the manifest, replication and SSM publish wait for all platforms.
+
+    :param downloader: The SensorDownloader to stage the sensors with
+    :param args: The parsed command line
+    :return: The staging directories to delete and the regions that failed to publish
+    """
+    regions = args.aws_regions.split(",")
+    os.makedirs(packager.PATH_TO_BUCKET_FOLDER, exist_ok=True)
+    bucket_updater = packager.S3BucketUpdater(regions[0], **packager.updater_args(args))
+    bucket_updater.ensure_bucket(args.s3bucket)
+    distributor = packager.create_packager(args)
+
+    staged_dirs = []
+
+    def ready_dirs():
+        for staged_dir in downloader.iter_downloads(binary_list, args.download_workers):
+            staged_dirs.append(staged_dir)
+            yield staged_dir
+
+    def upload(archive, sha):
+        bucket_updater.upload_files(
+            args.s3bucket, [archive], "falcon/", {archive: sha}, report=False
+        )
+
+    files = distributor.build_pipelined(
+        "agent_list.json", ready_dirs(), upload, args.upload_workers
+    )
+    bucket_updater.upload_files(
+        args.s3bucket, [distributor.manifest_name], "falcon/", report=False
+    )
+    bucket_updater.report_transfers()
+    print("Package file have been built and uploaded successfully.")
+
+    failed_regions = packager.publish_build(args, bucket_updater, distributor, files)
+    return staged_dirs, failed_regions
+
+
+def load_package_definitions(path):
+    """Read the package definitions of a --packages file.
+
+    :param path: JSON file with a list of {"package_name": ..., "sensor_version": ...}
+        objects; sensor_version is optional and defaults to "n-1"
+    :return: The package definitions
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as file_handle:
+            definitions = json.load(file_handle)
+    except (OSError, ValueError) as err:
+        raise SystemExit(f"Unable to read package definitions from {path}: {err}") from err
+
+    if not isinstance(definitions, list) or not all(
+        isinstance(definition, dict) and definition.get("package_name")
+        for definition in definitions
+    ):
+        raise SystemExit(f"{path} must contain a list of objects with a package_name.")
+    names = [definition["package_name"] for definition in definitions]
+    if not names or len(set(names)) != len(names):
+        raise SystemExit(f"{path} must define at least one package and no duplicate package_name.")
+    return definitions
+
+
+def stage_packages(downloader, definitions, workers=1):
+    """Stage the sensors of several packages, downloading each unique installer once.
+
+    Every selected sensor is staged in a directory named after its platform
+    and sha256, so packages that select the same sensor share the staging
+    directory, and with it the archive and the uploaded object. Each distinct
+    sha256 is downloaded once and linked or copied into the staging
+    directories of the other platforms that use the same installer.
+
+    :param downloader: The SensorDownloader to stage the sensors with
+    :param definitions: The package definitions, see load_package_definitions
+    :param workers: The number of sensors queried and downloaded concurrently
+    :return: Dictionary of {package name: agent_list.json contents pointing at
+        the package's archives} and the staging directories
+    """
+    with open("agent_list.json", "r", encoding="utf-8") as file_handle:
+        agent_list = json.load(file_handle)
+
+    # Query every filter once up front; the packages then select from the results
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(downloader.resolve, binary_list))
+
+    artifacts = {}
+    shas = {}
+    mappings = {}
+    for definition in definitions:
+        staged = {}
+        for binary in binary_list:
+            selected = {**binary, "sensor_version": definition.get("sensor_version", "n-1")}
+            sha = downloader.resolve(selected)["sha256"]
+            os_dir, installer_file = os.path.split(binary["path"])
+            staged[os_dir] = f"{os_dir}_{sha[:12]}"
+            artifacts[staged[os_dir]] = {
+                **selected,
+                "path": os.path.join(staged[os_dir], installer_file),
+            }
+            shas[staged[os_dir]] = sha
+        mappings[definition["package_name"]] = {
+            os_type: [
+                {
+                    **installer,
+                    "dir": staged[installer["dir"]],
+                    "file": staged[installer["dir"]] + ".zip",
+                }
+                for installer in installers
+            ]
+            for os_type, installers in agent_list.items()
+        }
+
+    downloads = {}
+    for staged_dir, artifact in artifacts.items():
+        downloads.setdefault(shas[staged_dir], artifact)
+    print(
+        f"Downloading {len(downloads)} unique sensors for {len(artifacts)} staging "
+        f"directories of {len(definitions)} packages "
+        f"instead of {len(binary_list) * len(definitions)}"
+    )
+    staged_dirs = downloader.download_all(list(downloads.values()), workers)
+    for staged_dir, artifact in artifacts.items():
+        downloaded = downloads[shas[staged_dir]]
+        if artifact is not downloaded:
+            staged_dirs.append(downloader.stage_from(artifact, downloaded["path"]))
+    return mappings, staged_dirs
+
+
+def build_packages(downloader, args, definitions):
+    """Build and publish several packages from one set of sensor downloads.
+
+    Archives are built and uploaded once per unique staging directory: the
+    build journal lets each package reuse the archives and uploads of the
+    packages built before it. Only the manifests and SSM documents differ.
+
+    :param downloader: The SensorDownloader to stage the sensors with
+    :param args: The parsed command line
+    :param definitions: The package definitions, see load_package_definitions
+    :return: The staging directories to delete and the regions that failed to publish
+    """
+    mappings, staged_dirs = stage_packages(downloader, definitions, args.download_workers)
+
+    regions = args.aws_regions.split(",")
+    os.makedirs(packager.PATH_TO_BUCKET_FOLDER, exist_ok=True)
+    bucket_updater = packager.S3BucketUpdater(regions[0], **packager.updater_args(args))
+    distributor = packager.create_packager(args)
+
+    files = set()
+    checksums = {}
+    failed_regions = []
+    for package_name, package_mappings in mappings.items():
+        print(f"Building distributor package {package_name}")
+        distributor.manifest_name = f"manifest-{package_name}.json"
+        package_files = distributor.build(package_mappings)
+        bucket_updater.update(
+            args.s3bucket, sorted(package_files), "falcon/", distributor.checksums
+        )
+        files |= package_files
+        checksums.update(distributor.checksums)
+        # Pass the files of every package built so far so the earlier
+        # packages' archives are not mistaken for supporting files.
+        failed_regions += [
+            f"{region} ({package_name})"
+            for region in packager.distribute(
+                bucket_updater,
+                args.s3bucket,
+                regions,
+                package_name,
+                files,
+                checksums,
+                replicate=args.replicate,
+                region_workers=args.region_workers,
+                keep_versions=args.keep_versions,
+                manifest_name=distributor.manifest_name,
+                **packager.updater_args(args),
+            )
+        ]
+
+    if not failed_regions:
+        packager.clean_workspace(args)
+    return staged_dirs, failed_regions
+
+
+def main(argv=None):
+    """Download the sensors and build the distributor package.
+
+    :param argv: Arguments to parse instead of sys.argv
+    """
+    args = parse_command_line(argv)
+
+    client_id = os.environ.get("FALCON_CLIENT_ID")
+    client_secret = os.environ.get("FALCON_CLIENT_SECRET")
+
+    if not client_id:
+        raise ValueError("FALCON_CLIENT_ID environment variable not set.")
+
+    if not client_secret:
+        raise ValueError("FALCON_CLIENT_SECRET environment variable not set.")
+
+    instrumentation.configure(
+        "create-package", args.profile_stage, args.profile_kind, args.metrics_dir
+    )
+
+    falcon = RateLimitedFalcon(
+        load_api_harness()(
+            client_id=os.environ.get("FALCON_CLIENT_ID"),
+            client_secret=os.environ.get("FALCON_CLIENT_SECRET"),
+        ),
+        max_retries=args.api_retries,
+    )
+
+    sensor_cache = None
+    if args.cache_dir:
+        sensor_cache = SensorCache(args.cache_dir, args.cache_max_size * 1024 * 1024)
+
+    downloader = SensorDownloader(falcon, sensor_cache)
+    if args.batch_query:
+        print("Fetching sensor installer catalogue...")
+        downloader.sensor_index = SensorIndex(downloader.fetch_catalogue())
+
+    definitions = load_package_definitions(args.packages) if args.packages else None
+
+    journal.start(packager.BUILD_JOURNAL_FILE, args.resume)
+    print("Downloading required files...")
+
+    if definitions:
+        dirs_to_delete, failed_regions = build_packages(downloader, args, definitions)
+    elif args.pipeline:
+        dirs_to_delete, failed_regions = build_pipelined(downloader, args)
+    else:
+        dirs_to_delete = downloader.download_all(binary_list, args.download_workers)
+        # The packager runs in-process so it shares this process's client
+        # pool and instrumentation.
+        failed_regions = packager.build_and_publish(args)
+
+    # On failure the staged sensors are kept so the run can be continued with --resume
+    if not failed_regions:
+        with instrumentation.span("cleanup", directories=len(dirs_to_delete)):
+            for d in dirs_to_delete:
+                shutil.rmtree(d)
+    if args.metrics_dir:
+        instrumentation.write(args.metrics_dir, "create-package")
+    if failed_regions:
+        raise SystemExit(
+            f"Failed to publish the distributor package to: {', '.join(failed_regions)}"
+        )
+    package_names = (
+        [definition["package_name"] for definition in definitions]
+        if definitions
+        else [args.package_name]
+    )
+    print(
+        f"Package {', '.join(package_names)} created successfully in region {args.aws_regions}."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Per-stage timing and throughput instrumentation for the packaging scripts.
+
+Stages are timed with spans that record their duration, bytes processed and
+retries. At the end of a run the spans are written as JSON lines and the
+per-stage totals as a Prometheus textfile. A single stage can optionally be
+profiled with cProfile or tracemalloc.
+"""
+
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+STAGES = ["query", "download", "zip", "hash", "upload", "replicate", "ssm_publish", "cleanup"]
+PROFILE_KINDS = ["cprofile", "tracemalloc"]
+
+
+class _Recorder:
+    """Thread-safe collection of the spans recorded during a run."""
+
+    def __init__(self):
+        self.spans = []
+        self.retries = {}
+        self.profile_stage = None
+        self.profile_kind = None
+        self.profile_path = None
+        self._profiling = False
+        self._lock = threading.Lock()
+
+    def add_retries(self, stage, count):
+        """Attribute retries to a stage."""
+        with self._lock:
+            self.retries[stage] = self.retries.get(stage, 0) + count
+
+    def record(self, span):
+        """Store a finished span."""
+        with self._lock:
+            self.spans.append(span)
+
+    def claim_profiler(self, stage):
+        """Return True if this span of stage should be profiled."""
+        with self._lock:
+            if stage != self.profile_stage or self._profiling:
+                return False
+            self._profiling = True
+            return True
+
+    def totals(self):
+        """Aggregate the recorded spans by stage."""
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                stage = totals.setdefault(
+                    span["stage"], {"seconds": 0.0, "bytes": 0, "spans": 0, "retries": 0}
+                )
+                stage["seconds"] += span["seconds"]
+                stage["bytes"] += span["bytes"]
+                stage["spans"] += 1
+            for stage, count in self.retries.items():
+                totals.setdefault(
+                    stage, {"seconds": 0.0, "bytes": 0, "spans": 0, "retries": 0}
+                )["retries"] = count
+        return totals
+
+
+_recorder = _Recorder()
+# The spans open on each thread, innermost last
+_active = threading.local()
+
+
+def configure(process, profile_stage=None, profile_kind="cprofile", output_dir=None):
+    """
+    Configure optional profiling of a single stage
+    :param process: Name of the script, used in the profile file name
+    :param profile_stage: One of STAGES, or None to disable profiling
+    :param profile_kind: One of PROFILE_KINDS
+    :param output_dir: Directory the profile is written to; defaults to the working directory
+    """
+    _recorder.profile_stage = profile_stage
+    _recorder.profile_kind = profile_kind
+    _recorder.profile_path = os.path.join(
+        output_dir or ".", f"{process}-{profile_stage}.{profile_kind}"
+    )
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Time a block of work as a span of a pipeline stage
+    :param stage: One of STAGES
+    :param labels: Extra fields stored with the span
+    :return: The span record; add processed bytes to span["bytes"]. Retries
+        recorded for stage on the same thread are counted in span["retries"]
+    """
+    record = {"stage": stage, "bytes": 0, "retries": 0, **labels}
+    if not hasattr(_active, "spans"):
+        _active.spans = []
+    _active.spans.append(record)
+    profiling = _recorder.claim_profiler(stage)
+    if profiling and _recorder.profile_kind == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profiling:
+        tracemalloc.start()
+    start_time = time.time()
+    try:
+        yield record
+    finally:
+        _active.spans.pop()
+        record["start"] = start_time
+        record["seconds"] = time.time() - start_time
+        if profiling and _recorder.profile_kind == "cprofile":
+            profiler.disable()
+            profiler.dump_stats(_recorder.profile_path)
+        elif profiling:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(_recorder.profile_path, "w", encoding="utf-8") as file_handle:
+                file_handle.write(f"peak_bytes {peak}\n")
+                for stat in snapshot.statistics("lineno")[:50]:
+                    file_handle.write(f"{stat}\n")
+        _recorder.record(record)
+
+
+def record(stage, seconds, nbytes=0, **labels):
+    """Record a span for work that was timed elsewhere, such as in a worker process."""
+    _recorder.record(
+        {
+            "stage": stage,
+            "bytes": nbytes,
+            "retries": 0,
+            **labels,
+            "start": time.time() - seconds,
+            "seconds": seconds,
+        }
+    )
+
+
+def add_retries(stage, count=1):
+    """Record retries made on behalf of a stage.
+
+    The retries are also added to the innermost open span of stage on the
+    calling thread. Retries made on threads without such a span, such as
+    those of managed S3 transfers, only count towards the stage total.
+    """
+    if count:
+        _recorder.add_retries(stage, count)
+        for record in reversed(getattr(_active, "spans", [])):
+            if record["stage"] == stage:
+                record["retries"] += count
+                break
+
+
+def instrument_client(client, operation_stages):
+    """
+    Count the retries botocore makes for a client's calls
+    :param client: A boto3 client
+    :param operation_stages: Dictionary of {operation name: stage}
+    """
+
+    def after_call(model, parsed, **_):
+        stage = operation_stages.get(model.name)
+        if stage:
+            add_retries(stage, parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0))
+
+    client.meta.events.register("after-call", after_call)
+
+
+def write(metrics_dir, process):
+    """
+    Write the recorded spans as JSON lines and the stage totals as a Prometheus textfile
+    :param metrics_dir: Directory to write metrics.jsonl and <process>.prom to
+    :param process: Name of the script, used as a metric label
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    totals = _recorder.totals()
+    with open(os.path.join(metrics_dir, "metrics.jsonl"), "a", encoding="utf-8") as file_handle:
+        for record in _recorder.spans:
+            file_handle.write(json.dumps({"process": process, **record}) + "\n")
+        for stage, total in totals.items():
+            file_handle.write(
+                json.dumps({"process": process, "stage": stage, "summary": True, **total}) + "\n"
+            )
+
+    # The _total metrics only grow during a run, so they are counters that
+    # reset with each run.
+    metrics = [
+        ("seconds", "distributor_stage_duration_seconds", "gauge", "Time spent in each pipeline stage."),
+        ("bytes", "distributor_stage_bytes_total", "counter", "Bytes processed by each pipeline stage."),
+        ("spans", "distributor_stage_spans_total", "counter", "Spans recorded for each pipeline stage."),
+        ("retries", "distributor_stage_retries_total", "counter", "Retries made by each pipeline stage."),
+    ]
+    lines = []
+    for key, name, metric_type, description in metrics:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for stage, total in sorted(totals.items()):
+            lines.append(f'{name}{{process="{process}",stage="{stage}"}} {total[key]}')
+    prom_path = os.path.join(metrics_dir, f"{process}.prom")
+    # Write atomically so a textfile collector never reads a partial file
+    with open(prom_path + ".tmp", "w", encoding="utf-8") as file_handle:
+        file_handle.write("\n".join(lines) + "\n")
+    os.replace(prom_path + ".tmp", prom_path)
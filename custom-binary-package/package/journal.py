@@ -0,0 +1,121 @@
+"""Crash-safe journal of completed build stages, used to resume interrupted runs.
+
+Each completed unit of work (a downloaded sensor, a built archive, an
+uploaded object, a published region, ...) is appended to the journal as a
+JSON line and flushed before the run moves on, so the entries survive the
+process being killed. The journal is only synced to disk as each stage
+completes; entries lost to a system crash just mean that work is redone. A
+run started with resume reloads the journal and skips work whose recorded
+checksum still matches; any other run starts a fresh journal. The journal is
+removed once a run completes successfully.
+"""
+
+import json
+import os
+import threading
+
+_lock = threading.Lock()
+_entries = {}
+_file = None
+_resuming = False
+
+
+def start(path, resume=False):
+    """
+    Open the journal for this run; does nothing if it is already open
+    :param path: The journal file
+    :param resume: Keep the entries of the previous run instead of starting afresh
+    """
+    global _file, _resuming  # pylint: disable=W0603
+    with _lock:
+        if _file is not None:
+            return
+        _resuming = resume
+        _entries.clear()
+        if resume:
+            try:
+                with open(path, "r", encoding="utf-8") as file_handle:
+                    for line in file_handle:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # A torn final line from a crash mid-write
+                            continue
+                        _entries[(entry.pop("stage"), entry.pop("key"))] = entry
+            except FileNotFoundError:
+                pass
+        _file = open(path, "a" if resume else "w", encoding="utf-8")  # pylint: disable=R1732
+        if _file.tell() and _torn(path):
+            # Terminate the torn line so the next entry starts on its own line
+            _file.write("\n")
+            _file.flush()
+
+
+def _torn(path):
+    """Return True if the journal file does not end with a complete line."""
+    with open(path, "rb") as file_handle:
+        file_handle.seek(-1, os.SEEK_END)
+        return file_handle.read(1) != b"\n"
+
+
+def finish():
+    """Close and remove the journal once a run has completed successfully."""
+    global _file, _resuming  # pylint: disable=W0603
+    with _lock:
+        if _file is None:
+            return
+        _resuming = False
+        _file.close()
+        os.remove(_file.name)
+        _file = None
+        _entries.clear()
+
+
+def active():
+    """Return True if a journal is open for this run."""
+    return _file is not None
+
+
+def resuming():
+    """Return True if this run continues the journal of a previous run."""
+    return _file is not None and _resuming
+
+
+def record(stage, key, **fields):
+    """
+    Durably record a completed unit of work
+    :param stage: The stage the work belongs to, such as "upload"
+    :param key: Identifies the unit of work within the stage
+    :param fields: Details needed to verify and reuse the work, such as its sha256
+    """
+    with _lock:
+        if _file is None:
+            return
+        _entries[(stage, key)] = fields
+        _file.write(json.dumps({"stage": stage, "key": key, **fields}) + "\n")
+        _file.flush()
+
+
+def sync():
+    """Sync the recorded entries to disk; called when a stage completes."""
+    with _lock:
+        if _file is not None:
+            os.fsync(_file.fileno())
+
+
+def get(stage, key):
+    """Return the recorded fields of a unit of work, or None if it was not completed."""
+    with _lock:
+        return _entries.get((stage, key))
+
+
+def entries(stage):
+    """Return a dictionary of {key: fields} for the completed work of a stage."""
+    with _lock:
+        return {key: fields for (entry_stage, key), fields in _entries.items() if entry_stage == stage}
+
+
+def completed(stage, key, sha256):
+    """Return True if the unit of work was completed for content with this sha256."""
+    entry = get(stage, key)
+    return entry is not None and entry.get("sha256") == sha256
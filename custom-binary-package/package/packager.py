@@ -8,50 +8,133 @@ import argparse
 import hashlib
 import json
 import logging
+import math
 import os
+import re
 import shutil
 import sys
+import threading
 import time
 import zipfile
-from functools import cached_property
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property, partial
 from logging.handlers import RotatingFileHandler
 from os.path import basename
 
-import boto3
 from botocore.exceptions import BotoCoreError, ClientError
 
-logging.basicConfig(level=logging.INFO)
+import instrumentation
+import journal
+
+logging.basicConfig(level=logging.INFO, format="%(levelname)-8s %(message)s")
 logger = logging.getLogger()
-handler = logging.StreamHandler()
-formatter = logging.Formatter("%(levelname)-8s %(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
 
 PATH_TO_BUCKET_FOLDER = "./s3-bucket/"
+BUILD_STATE_FILE = "./.build-state.json"
+BUILD_JOURNAL_FILE = "./.build-journal.jsonl"
+HASH_CHUNK_SIZE = 1024 * 1024
+REPRODUCIBLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+COMPRESSION_MODES = ["deflate", "store", "auto"]
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_STORE_RATIO = 0.95
+MB = 1024 * 1024
+CLIENT_CONFIG = {
+    "max_pool_connections": 50,
+    "retries": {"max_attempts": 10, "mode": "adaptive"},
+}
 PACKAGE_DESCRIPTION = "CrowdStrike custom Install Package"
 INSTALLER_VERSION = "1.0"
 OS_LIST = ["windows", "linux"]
+DOCUMENT_DELETE_WORKERS = 4
+# Archives, manifests and partially written archives of any package build;
+# these are never uploaded as supporting files.
+PACKAGE_FILE = re.compile(r".+\.zip|manifest(-.+)?\.json|.+\.partial")
+# Tag recording the bucket a distributor package document was published from
+SOURCE_URL_TAG = "SourceUrl"
+OPERATION_STAGES = {
+    "HeadBucket": "upload",
+    "CreateBucket": "upload",
+    "ListObjectsV2": "upload",
+    "HeadObject": "upload",
+    "PutObject": "upload",
+    "CreateMultipartUpload": "upload",
+    "UploadPart": "upload",
+    "CompleteMultipartUpload": "upload",
+    "ListParts": "upload",
+    "AbortMultipartUpload": "upload",
+    "CopyObject": "replicate",
+    "UploadPartCopy": "replicate",
+    "GetDocument": "ssm_publish",
+    "CreateDocument": "ssm_publish",
+    "UpdateDocument": "ssm_publish",
+    "UpdateDocumentDefaultVersion": "ssm_publish",
+    "ListTagsForResource": "ssm_publish",
+    "AddTagsToResource": "ssm_publish",
+    "ListDocumentVersions": "cleanup",
+    "DeleteDocument": "cleanup",
+}
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service, region):
+    """
+    Return the shared boto3 client for a service and region
+    :param service: The AWS service name
+    :param region: The AWS region
+    :return: A client with a tuned connection pool and adaptive retries
+    """
+    # boto3 is imported on first use so --help and offline builds start quickly
+    import boto3  # pylint: disable=C0415
+    from botocore.config import Config  # pylint: disable=C0415
+
+    with _clients_lock:
+        if (service, region) not in _clients:
+            client = boto3.client(
+                service, region_name=region, config=Config(**CLIENT_CONFIG)
+            )
+            instrumentation.instrument_client(client, OPERATION_STAGES)
+            _clients[(service, region)] = client
+        return _clients[(service, region)]
+
+
+def sha256_file(file_path):
+    """Generate the sha256 of a file, reading it in bounded chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 class SSMPackageUpdater:  # pylint: disable=R0903
     """Class to represent our SSM package update."""
 
-    def __init__(self, region_name):
+    def __init__(self, region_name, keep_versions=None):
         self.region = region_name
+        self.keep_versions = keep_versions
 
-    def update(self, package, file_to_upload):
-        """Update the SSM package."""
+    def update(self, package, file_to_upload, bucket):
+        """Update the SSM package.
+
+        :param package: The name of the distributor package
+        :param file_to_upload: Path to the manifest.json to publish
+        :param bucket: The S3 bucket holding the package files
+        :return: "created", "updated" or "unchanged"
+        """
         with open(file_to_upload, "r", encoding="utf-8") as open_file:
             document_content = open_file.read()
-        self._doc_update_or_create(
+        status = self._doc_update_or_create(
             Content=document_content,
             Attachments=[
                 {
                     "Key": "SourceUrl",
                     "Values": [
                         "https://"
-                        + s3bucket
+                        + bucket
                         + ".s3-"
                         + self.region
                         + ".amazonaws.com/falcon",
@@ -64,13 +147,70 @@ class SSMPackageUpdater:  # pylint: disable=R0903
         )
 
         print(f"Created ssm package {package}:")
+        return status
 
     def _doc_update_or_create(self, **kwargs):
         """Determine if this is an update or create."""
-        if self._doc_exists(kwargs["Name"]):
-            self._doc_update(**kwargs)
-        else:
-            self._client.create_document(**kwargs)
+        current_doc = self._doc_exists(kwargs["Name"])
+        # get_document only returns download links for the attachments, so the
+        # source the document was published from is kept in a tag.
+        source_url = kwargs["Attachments"][0]["Values"][0]
+        if current_doc:
+            if self._doc_matches(current_doc, kwargs["Content"]):
+                return self._doc_unchanged(kwargs["Name"], source_url)
+            if self.keep_versions is not None:
+                self._doc_cleanup_versions(kwargs["Name"], keep=self.keep_versions)
+            status = self._doc_update(**kwargs)
+            if status == "updated":
+                self._tag_source(kwargs["Name"], source_url)
+            return status
+        self._client.create_document(
+            **kwargs, Tags=[{"Key": SOURCE_URL_TAG, "Value": source_url}]
+        )
+        return "created"
+
+    def _doc_unchanged(self, package, source_url):
+        """Skip a document whose deployed content already matches the manifest.
+
+        SSM only compares the content, so the attachments of an unchanged
+        manifest can not be moved to another bucket without deleting the
+        document and its version history. The document keeps its previous
+        SourceUrl instead, which still serves the same files.
+
+        :param package: The name of the distributor package
+        :param source_url: The SourceUrl the package files were uploaded to
+        :return: "unchanged"
+        """
+        source = self._doc_source(package)
+        if source is None:
+            # Published before the source was tagged; its attachments can not
+            # be read back, so record the source of this identical manifest.
+            self._tag_source(package, source_url)
+        elif source != source_url:
+            print(
+                f"AWS SSM Package in {self.region} has an identical manifest, "
+                f"keeping its attachments from {source} instead of {source_url}"
+            )
+            return "unchanged"
+        print(
+            f"AWS SSM Package in {self.region} already has an identical manifest, skipping update"
+        )
+        return "unchanged"
+
+    def _tag_source(self, package, source_url):
+        """Record the SourceUrl a document was published from."""
+        self._client.add_tags_to_resource(
+            ResourceType="Document",
+            ResourceId=package,
+            Tags=[{"Key": SOURCE_URL_TAG, "Value": source_url}],
+        )
+
+    def _doc_source(self, package):
+        """Return the SourceUrl the document was last published from, or None if unknown."""
+        tags = self._client.list_tags_for_resource(
+            ResourceType="Document", ResourceId=package
+        )["TagList"]
+        return next((tag["Value"] for tag in tags if tag["Key"] == SOURCE_URL_TAG), None)
 
     def _doc_exists(self, package):
         """Document exists."""
@@ -80,6 +220,14 @@ class SSMPackageUpdater:  # pylint: disable=R0903
             current_doc = {}
         return current_doc
 
+    @staticmethod
+    def _doc_matches(current_doc, content):
+        """Compare the deployed document content with a new manifest, ignoring formatting."""
+        try:
+            return json.loads(current_doc.get("Content", "")) == json.loads(content)
+        except ValueError:
+            return False
+
     def _doc_update(self, **kwargs):
         """Perform the document update."""
         del kwargs["DocumentType"]
@@ -88,7 +236,7 @@ class SSMPackageUpdater:  # pylint: disable=R0903
             updated = self._client.update_document(**kwargs)
         except self._client.exceptions.DuplicateDocumentContent:
             print("AWS SSM Package is already up to date with the latest version")
-            return
+            return "unchanged"
         except self._client.exceptions.DocumentVersionLimitExceeded:
             self._doc_cleanup_versions(kwargs["Name"])
             updated = self._client.update_document(**kwargs)
@@ -97,37 +245,430 @@ class SSMPackageUpdater:  # pylint: disable=R0903
             Name=kwargs["Name"],
             DocumentVersion=updated["DocumentDescription"]["DocumentVersion"],
         )
+        return "updated"
 
-    def _doc_cleanup_versions(self, package):
-        """Cleanup document versions."""
-        for version in self._client.list_document_versions(Name=package)[
-            "DocumentVersions"
-        ]:
-            if version["IsDefaultVersion"]:
-                continue
-            self._client.delete_document(
-                Name=package, DocumentVersion=version["DocumentVersion"]
-            )
+    def _doc_cleanup_versions(self, package, keep=0):
+        """Cleanup document versions.
+
+        :param package: The name of the distributor package
+        :param keep: The number of newest non-default versions to retain
+        """
+        with instrumentation.span("cleanup", region=self.region, package=package):
+            versions = []
+            paginator = self._client.get_paginator("list_document_versions")
+            for page in paginator.paginate(Name=package):
+                versions.extend(
+                    version["DocumentVersion"]
+                    for version in page["DocumentVersions"]
+                    if not version["IsDefaultVersion"]
+                )
+            versions.sort(key=int, reverse=True)
+            surplus = versions[keep:]
+            if not surplus:
+                return
+            print(f"Deleting {len(surplus)} old versions of {package} in {self.region}")
+
+            def delete(version):
+                self._client.delete_document(Name=package, DocumentVersion=version)
+
+            # The shared client uses adaptive retries, which back off when SSM
+            # throttles these concurrent deletes.
+            with ThreadPoolExecutor(max_workers=DOCUMENT_DELETE_WORKERS) as executor:
+                list(executor.map(delete, surplus))
 
     @cached_property
     def _client(self):
         """Return an instance of the SSM boto3 client."""
-        return boto3.client("ssm", region_name=self.region)
+        return get_client("ssm", self.region)
 
 
 class S3BucketUpdater:  # pylint: disable=R0903
     """Class to represent our S3 Bucket update."""
 
-    def __init__(self, region_name):
+    def __init__(  # pylint: disable=R0913
+        self,
+        region_name,
+        multipart=False,
+        upload_workers=4,
+        part_size=8 * MB,
+        part_workers=10,
+        sync=False,
+    ):
         self.region = region_name
+        self.multipart = multipart
+        self.sync = sync
+        self.upload_workers = upload_workers
+        from boto3.s3.transfer import TransferConfig  # pylint: disable=C0415
+
+        self.transfer_config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=part_workers,
+        )
+        self._listings = {}
+        self._listings_lock = threading.Lock()
+        # Unreported managed transfers, see report_transfers
+        self._transfers = {"uploaded": 0, "files": 0, "bytes": 0, "start": None, "end": None}
+        self._transfers_lock = threading.Lock()
 
-    def update(self, bucket_name, file_list, prefix=""):
-        """Update the bucket contents."""
+    def update(self, bucket_name, file_list, prefix="", checksums=None):
+        """Update the bucket contents.
+
+        :param bucket_name: The name of the S3 bucket
+        :param file_list: Files in PATH_TO_BUCKET_FOLDER to upload
+        :param prefix: Key prefix for the uploaded objects
+        :param checksums: Optional dictionary of {filename: sha256}; missing
+            checksums are computed from the local files
+        """
+        self.ensure_bucket(bucket_name)
+        self.upload_files(bucket_name, file_list, prefix, checksums)
+
+    def ensure_bucket(self, bucket_name):
+        """Create the bucket if it does not exist yet."""
         if not self._bucket_exists(bucket_name):
             self._create_bucket(bucket_name)
-        for file in file_list:
-            file_path = PATH_TO_BUCKET_FOLDER + file
-            self._upload_file(file_path, bucket_name, prefix + file)
+
+    def upload_files(  # pylint: disable=R0913
+        self, bucket_name, file_list, prefix="", checksums=None, report=True
+    ):
+        """Upload files to a bucket that already exists.
+
+        :param bucket_name: The name of the S3 bucket
+        :param file_list: Files in PATH_TO_BUCKET_FOLDER to upload
+        :param prefix: Key prefix for the uploaded objects
+        :param checksums: Optional dictionary of {filename: sha256}
+        :param report: Print the throughput of managed transfers; if False
+            they are added to the totals printed by report_transfers
+        """
+        with instrumentation.span("upload", region=self.region, bucket=bucket_name) as span:
+            checksums = dict(checksums or {})
+            for file in file_list:
+                if file not in checksums:
+                    checksums[file] = sha256_file(PATH_TO_BUCKET_FOLDER + file)
+            file_list = self._unfinished_files("upload", bucket_name, file_list, prefix, checksums)
+            if self.sync:
+                file_list = self._changed_files(bucket_name, file_list, prefix, checksums)
+            if self.multipart:
+                span["bytes"] = self._transfer_files(
+                    bucket_name, file_list, prefix, checksums, report
+                )
+            else:
+                for file in file_list:
+                    file_path = PATH_TO_BUCKET_FOLDER + file
+                    if self._upload_file(file_path, bucket_name, prefix + file, checksums[file]):
+                        span["bytes"] += os.path.getsize(file_path)
+        journal.sync()
+
+    def replicate(  # pylint: disable=R0913
+        self, source, source_bucket, bucket_name, file_list, prefix="", checksums=None
+    ):
+        """Copy files server side from another region's bucket into this region.
+
+        :param source: The S3BucketUpdater of the source region
+        :param source_bucket: The bucket the files were uploaded to
+        :param bucket_name: The bucket to replicate into
+        :param file_list: Files in PATH_TO_BUCKET_FOLDER to replicate
+        :param prefix: Key prefix of the objects
+        :param checksums: Optional dictionary of {filename: sha256}
+        """
+        with instrumentation.span("replicate", region=self.region, bucket=bucket_name) as span:
+            self.ensure_bucket(bucket_name)
+            checksums = dict(checksums or {})
+            for file in file_list:
+                if file not in checksums:
+                    checksums[file] = sha256_file(PATH_TO_BUCKET_FOLDER + file)
+            file_list = self._unfinished_files(
+                "replicate", bucket_name, file_list, prefix, checksums
+            )
+            if self.sync:
+                file_list = self._changed_files(bucket_name, file_list, prefix, checksums)
+            span["bytes"] = self._copy_files(
+                source, source_bucket, bucket_name, file_list, prefix, checksums
+            )
+        journal.sync()
+
+    def _copy_files(  # pylint: disable=R0913
+        self, source, source_bucket, bucket_name, file_list, prefix, checksums
+    ):
+        """Copy files server side concurrently and return the number of bytes copied."""
+
+        def copy(file):
+            self._client.copy(
+                {"Bucket": source_bucket, "Key": prefix + file},
+                bucket_name,
+                prefix + file,
+                ExtraArgs={
+                    "Metadata": {"sha256": checksums[file]},
+                    "MetadataDirective": "REPLACE",
+                },
+                SourceClient=source._client,  # pylint: disable=W0212
+                Config=self.transfer_config,
+            )
+            journal.record(
+                "replicate", f"s3://{bucket_name}/{prefix}{file}", sha256=checksums[file]
+            )
+            return os.path.getsize(PATH_TO_BUCKET_FOLDER + file)
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            total_bytes = sum(executor.map(copy, file_list))
+        print(
+            f"Replicated {len(file_list)} files ({total_bytes / MB:.1f} MB) from s3://{source_bucket} "
+            f"to s3://{bucket_name} in {time.time() - start_time:.2f}s"
+        )
+        return total_bytes
+
+    @staticmethod
+    def _unfinished_files(stage, bucket_name, file_list, prefix, checksums):
+        """Filter out files the journal records as already transferred with the same content."""
+        unfinished = [
+            file
+            for file in file_list
+            if not journal.completed(stage, f"s3://{bucket_name}/{prefix}{file}", checksums[file])
+        ]
+        if len(unfinished) < len(file_list):
+            print(
+                f"Skipping {len(file_list) - len(unfinished)} of {len(file_list)} files "
+                f"already transferred to s3://{bucket_name}/{prefix}"
+            )
+        return unfinished
+
+    def _changed_files(self, bucket_name, file_list, prefix, checksums):
+        """
+        Filter out files whose content is already stored in the bucket
+        :param bucket_name: The name of the S3 bucket
+        :param file_list: Candidate files to upload
+        :param prefix: Key prefix for the uploaded objects
+        :param checksums: Dictionary of {filename: sha256}
+        :return: The files that are missing or differ in the bucket
+        """
+        remote_sizes = self._remote_sizes(bucket_name, prefix)
+
+        def is_current(file):
+            key = prefix + file
+            if remote_sizes.get(key) != os.path.getsize(PATH_TO_BUCKET_FOLDER + file):
+                return False
+            try:
+                head = self._client.head_object(Bucket=bucket_name, Key=key)
+            except ClientError:
+                return False
+            return head.get("Metadata", {}).get("sha256") == checksums[file]
+
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            current = list(executor.map(is_current, file_list))
+        changed = [file for file, up_to_date in zip(file_list, current) if not up_to_date]
+        print(
+            f"{len(file_list) - len(changed)} of {len(file_list)} files are already "
+            f"up to date in s3://{bucket_name}/{prefix}"
+        )
+        return changed
+
+    def _remote_sizes(self, bucket_name, prefix):
+        """
+        List the sizes of the objects under a prefix, once per run
+        :param bucket_name: The name of the S3 bucket
+        :param prefix: Key prefix of the objects
+        :return: Dictionary of {key: size} as listed by the first call; an
+            object changed since then is uploaded again rather than skipped
+        """
+        with self._listings_lock:
+            if (bucket_name, prefix) not in self._listings:
+                remote_sizes = {}
+                paginator = self._client.get_paginator("list_objects_v2")
+                for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                    for obj in page.get("Contents", []):
+                        remote_sizes[obj["Key"]] = obj["Size"]
+                self._listings[(bucket_name, prefix)] = remote_sizes
+            return self._listings[(bucket_name, prefix)]
+
+    def report_transfers(self):
+        """Print the throughput of the managed transfers made with report=False.
+
+        The time is the wall time from the start of the first of these
+        transfers to the end of the last.
+        """
+        with self._transfers_lock:
+            totals = self._transfers
+            self._transfers = {"uploaded": 0, "files": 0, "bytes": 0, "start": None, "end": None}
+        if totals["start"] is not None:
+            self._print_throughput(
+                totals["uploaded"], totals["files"], totals["bytes"], totals["end"] - totals["start"]
+            )
+
+    @staticmethod
+    def _print_throughput(uploaded, files, nbytes, time_taken):
+        """Print how many files and bytes were uploaded and how fast."""
+        total_mb = nbytes / MB
+        print(
+            f"Uploaded {uploaded} of {files} files ({total_mb:.1f} MB) "
+            f"in {time_taken:.2f}s, {total_mb / max(time_taken, 1e-6):.1f} MB/s"
+        )
+
+    def _transfer_files(  # pylint: disable=R0913
+        self, bucket_name, file_list, prefix, checksums, report=True
+    ):
+        """Upload files concurrently using managed multipart transfers.
+
+        :param report: Print the throughput now rather than add it to the
+            totals printed by report_transfers
+        :return: The number of bytes uploaded
+        """
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            results = list(
+                executor.map(
+                    lambda file: self._transfer_file(
+                        PATH_TO_BUCKET_FOLDER + file,
+                        bucket_name,
+                        prefix + file,
+                        checksums[file],
+                    ),
+                    file_list,
+                )
+            )
+        end_time = time.time()
+        uploaded = [size for size in results if size is not None]
+        if report:
+            self._print_throughput(
+                len(uploaded), len(results), sum(uploaded), end_time - start_time
+            )
+        else:
+            with self._transfers_lock:
+                totals = self._transfers
+                totals["uploaded"] += len(uploaded)
+                totals["files"] += len(results)
+                totals["bytes"] += sum(uploaded)
+                totals["start"] = min(totals["start"] or start_time, start_time)
+                totals["end"] = max(totals["end"] or end_time, end_time)
+        return sum(uploaded)
+
+    def _transfer_file(self, file_name, bucket, object_name, checksum):
+        """Upload a single file with a managed multipart transfer
+
+        A run started with --resume uploads large files in journaled parts
+        instead, so that an interrupted upload can be continued.
+
+        :param file_name: File to upload
+        :param bucket: Bucket to upload to
+        :param object_name: S3 object name
+        :param checksum: sha256 of the file, stored as object metadata
+        :return: The number of bytes uploaded, or None if the upload failed
+        """
+        file_size = os.path.getsize(file_name)
+        try:
+            if journal.resuming() and file_size > self.transfer_config.multipart_threshold:
+                self._resumable_upload(file_name, bucket, object_name, checksum)
+            else:
+                self._client.upload_file(
+                    file_name,
+                    bucket,
+                    object_name,
+                    ExtraArgs={"Metadata": {"sha256": checksum}},
+                    Config=self.transfer_config,
+                )
+        except (BotoCoreError, ClientError) as err:
+            print(f"Upload error {err}")
+            return None
+        journal.record("upload", f"s3://{bucket}/{object_name}", sha256=checksum)
+        return file_size
+
+    def _resumable_upload(self, file_name, bucket, object_name, checksum):
+        """Upload a file in parts, continuing the multipart upload of an interrupted run.
+
+        The upload ID is journaled before any part is sent. A resumed run lists
+        the parts already stored and only re-sends those whose ETag does not
+        match the MD5 of the local part; with SSE-KMS the ETags are not MD5s,
+        so every part is re-sent. A journaled upload that can not be continued,
+        or that fails with a client error, is aborted so its parts are not left
+        stored. Uploads interrupted by a crash are only aborted by a later
+        resumed run, so the bucket should have a lifecycle rule that aborts
+        incomplete multipart uploads.
+
+        :param file_name: File to upload
+        :param bucket: Bucket to upload to
+        :param object_name: S3 object name
+        :param checksum: sha256 of the file, stored as object metadata
+        """
+        from s3transfer.utils import ChunksizeAdjuster  # pylint: disable=C0415
+
+        key = f"s3://{bucket}/{object_name}"
+        # Apply the S3 part size limits the managed transfers use
+        part_size = ChunksizeAdjuster().adjust_chunksize(
+            self.transfer_config.multipart_chunksize, os.path.getsize(file_name)
+        )
+        entry = journal.get("multipart", key)
+        upload_id = None
+        stored_parts = {}
+        if entry and entry["sha256"] == checksum and entry["part_size"] == part_size:
+            try:
+                paginator = self._client.get_paginator("list_parts")
+                for page in paginator.paginate(
+                    Bucket=bucket, Key=object_name, UploadId=entry["upload_id"]
+                ):
+                    for part in page.get("Parts", []):
+                        stored_parts[part["PartNumber"]] = part["ETag"]
+                upload_id = entry["upload_id"]
+                print(f"Resuming upload of {file_name} with {len(stored_parts)} parts stored")
+            except ClientError:
+                # The upload was completed, aborted or expired; start a new one
+                stored_parts = {}
+                self._abort_upload(bucket, object_name, entry["upload_id"])
+        elif entry:
+            # The file or part size changed, so the stored parts are useless
+            self._abort_upload(bucket, object_name, entry["upload_id"])
+        if upload_id is None:
+            upload_id = self._client.create_multipart_upload(
+                Bucket=bucket, Key=object_name, Metadata={"sha256": checksum}
+            )["UploadId"]
+            journal.record(
+                "multipart", key, sha256=checksum, upload_id=upload_id, part_size=part_size
+            )
+
+        def upload_part(part_number):
+            with open(file_name, "rb") as file_handle:
+                file_handle.seek((part_number - 1) * part_size)
+                body = file_handle.read(part_size)
+            etag = f'"{hashlib.md5(body, usedforsecurity=False).hexdigest()}"'
+            if stored_parts.get(part_number) == etag:
+                return etag
+            return self._client.upload_part(
+                Bucket=bucket,
+                Key=object_name,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )["ETag"]
+
+        part_count = max(math.ceil(os.path.getsize(file_name) / part_size), 1)
+        try:
+            with ThreadPoolExecutor(max_workers=self.transfer_config.max_concurrency) as executor:
+                etags = list(executor.map(upload_part, range(1, part_count + 1)))
+            self._client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=object_name,
+                UploadId=upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"ETag": etag, "PartNumber": number}
+                        for number, etag in enumerate(etags, start=1)
+                    ]
+                },
+            )
+        except ClientError:
+            # S3 rejected the upload, so retrying the same parts will not help.
+            # Connection errors leave the upload to be continued by --resume.
+            self._abort_upload(bucket, object_name, upload_id)
+            raise
+
+    def _abort_upload(self, bucket, object_name, upload_id):
+        """Abort a multipart upload so its stored parts are deleted."""
+        try:
+            self._client.abort_multipart_upload(
+                Bucket=bucket, Key=object_name, UploadId=upload_id
+            )
+        except ClientError:
+            # Already completed, aborted or expired
+            pass
 
     def _bucket_exists(self, bucket_name):
         """
@@ -136,17 +677,16 @@ class S3BucketUpdater:  # pylint: disable=R0903
         :return: True or False
         """
         try:
-            response = self._client.list_buckets()
+            self._client.head_bucket(Bucket=bucket_name)
         except ClientError as err:
-            print(f"Error listing buckets {err}")
-
-        # Output True if bucket exists
-
-        for bucket in response["Buckets"]:
-            if bucket_name == bucket["Name"]:
-                print("Bucket already exists:")
-                return True
-        return False
+            if err.response["Error"]["Code"] in ("404", "NoSuchBucket"):
+                return False
+            # A redirect means the bucket exists in another region
+            if err.response["Error"]["Code"] != "301":
+                print(f"Error checking bucket {err}")
+                raise
+        print("Bucket already exists:")
+        return True
 
     def _create_bucket(self, bucket_name):
         """Create an S3 bucket
@@ -156,17 +696,22 @@ class S3BucketUpdater:  # pylint: disable=R0903
         """
 
         print("Creating bucket:")
+        if self.region == "us-east-1":
+            # us-east-1 is the default location and rejects a LocationConstraint
+            self._client.create_bucket(Bucket=bucket_name)
+            return
         location = {"LocationConstraint": self.region}
         self._client.create_bucket(
             Bucket=bucket_name, CreateBucketConfiguration=location
         )
 
-    def _upload_file(self, file_name, bucket, object_name=None):
+    def _upload_file(self, file_name, bucket, object_name=None, checksum=None):
         """Upload a file to an S3 bucket
 
         :param file_name: File to upload
         :param bucket: Bucket to upload to
         :param object_name: S3 object name. If not specified then file_name is used
+        :param checksum: Optional sha256 of the file, stored as object metadata
         :return: True if file was uploaded, else False
         """
         # If S3 object_name was not specified, use file_name
@@ -176,8 +721,11 @@ class S3BucketUpdater:  # pylint: disable=R0903
         try:
             start_time = time.time()
             print(f"Uploading file {file_name}:")
+            metadata = {"sha256": checksum} if checksum else {}
             with open(file_name, "rb") as content:
-                self._client.put_object(Bucket=bucket, Key=object_name, Body=content)
+                self._client.put_object(
+                    Bucket=bucket, Key=object_name, Body=content, Metadata=metadata
+                )
             time_taken = time.time() - start_time
             print(
                 f"Successfully finished uploading files to s3 bucket. Took {time_taken}s"
@@ -185,43 +733,358 @@ class S3BucketUpdater:  # pylint: disable=R0903
         except (BotoCoreError, ClientError) as err:
             print(f"Upload error {err}")
             return False
+        journal.record("upload", f"s3://{bucket}/{object_name}", sha256=checksum)
         return True
 
     @cached_property
     def _client(self):
-        return boto3.client("s3", region_name=self.region)
+        return get_client("s3", self.region)
 
 
 class DistributorPackager:  # pylint: disable=R0903
     """Class to represent a Distributor package."""
 
+    def __init__(  # pylint: disable=R0913
+        self,
+        zip_workers=1,
+        incremental=False,
+        reproducible=False,
+        compression="deflate",
+        compression_level=None,
+        manifest_name="manifest.json",
+    ):
+        self.zip_workers = zip_workers
+        self.incremental = incremental
+        self.reproducible = reproducible
+        self.compression = compression
+        self.compression_level = compression_level
+        self.manifest_name = manifest_name
+        self.checksums = {}
+
     def build(self, mappings_file):
-        """Build the package."""
-        dirs = set()
-        file_list = set()
-        # arch = set()
+        """Build the package.
+
+        :param mappings_file: Path to agent_list.json, or its parsed contents
+        :return: The package files in PATH_TO_BUCKET_FOLDER
+        """
+        installer_list, archives = self._load_archives(mappings_file)
+        dirs = set(archives)
+
+        self._check_missing(dirs - set(os.listdir()))
+
+        state = self._load_state() if self.incremental else {}
+        state.update(journal.entries("archive"))
+        options = self._archive_options()
+        with instrumentation.span("hash", directories=len(dirs)) as span:
+            fingerprints = {}
+            for directory in dirs:
+                fingerprints[directory], hashed_bytes = self._hash_directory(directory)
+                span["bytes"] += hashed_bytes
+        hashes = {}
+        changed_dirs = []
+        for directory in sorted(dirs):
+            if self._is_unchanged(
+                state.get(directory), fingerprints[directory], options, archives[directory]
+            ):
+                print(f"Reusing unchanged archive {archives[directory]}")
+                hashes[archives[directory]] = state[directory]["sha256"]
+            else:
+                changed_dirs.append(directory)
+
+        create_zip_files = partial(self._create_zip_files, **options)
+        with instrumentation.span("zip", archives=len(changed_dirs)) as span:
+            if self.zip_workers > 1:
+                with ProcessPoolExecutor(max_workers=self.zip_workers) as executor:
+                    results = list(
+                        self._journal_archives(
+                            changed_dirs,
+                            executor.map(create_zip_files, changed_dirs),
+                            archives,
+                            fingerprints,
+                            options,
+                        )
+                    )
+            else:
+                results = list(
+                    self._journal_archives(
+                        changed_dirs,
+                        map(create_zip_files, changed_dirs),
+                        archives,
+                        fingerprints,
+                        options,
+                    )
+                )
+            span["bytes"] = sum(report["input_bytes"] for _, report in results)
+        for directory, (digest, _) in zip(changed_dirs, results):
+            hashes[archives[directory]] = digest
+        if results:
+            self._print_compression_report([report for _, report in results])
+
+        self.checksums = hashes
+        return self._finish(installer_list, archives, fingerprints, options)
 
-        installer_list = self._parse_mappings(mappings_file)
-        dir_list = os.listdir()
+    def build_pipelined(self, mappings_file, ready_dirs, upload, upload_workers=4):
+        """Build the package one platform at a time as each directory is staged.
 
+        Every archive is zipped, hashed and handed to upload as soon as its
+        directory is ready, so zipping overlaps with staging and uploading the
+        other platforms. Only the manifest waits for all of the archives.
+
+        :param mappings_file: Path to agent_list.json, or its parsed contents
+        :param ready_dirs: Iterable yielding each directory once it is fully staged
+        :param upload: Called with the archive name and its sha256 once it is built
+        :param upload_workers: The maximum number of archives uploaded at once
+        :return: The package files; the manifest is written but not uploaded
+        """
+        installer_list, archives = self._load_archives(mappings_file)
+        state = self._load_state() if self.incremental else {}
+        state.update(journal.entries("archive"))
+        options = self._archive_options()
+        upload_slots = threading.Semaphore(upload_workers)
+        if self.zip_workers > 1:
+            zip_executor = ProcessPoolExecutor(max_workers=self.zip_workers)
+        else:
+            zip_executor = ThreadPoolExecutor(max_workers=1)
+
+        def process(directory):
+            result = zip_executor.submit(
+                self._build_archive,
+                directory,
+                archives[directory],
+                state.get(directory),
+                options,
+            ).result()
+            instrumentation.record(
+                "hash", result["hash_seconds"], result["hash_bytes"], directory=directory
+            )
+            if result["report"]:
+                instrumentation.record(
+                    "zip",
+                    result["report"]["seconds"],
+                    result["report"]["input_bytes"],
+                    directory=directory,
+                )
+                self._record_archive(
+                    directory, archives[directory], result["fingerprint"], result["sha256"], options
+                )
+            else:
+                print(f"Reusing unchanged archive {archives[directory]}")
+            with upload_slots:
+                upload(archives[directory], result["sha256"])
+            return result
+
+        results = {}
+        with zip_executor, ThreadPoolExecutor(
+            max_workers=self.zip_workers + upload_workers
+        ) as executor:
+            futures = {}
+            try:
+                for directory in ready_dirs:
+                    if directory in archives:
+                        futures[directory] = executor.submit(process, directory)
+                for directory, future in futures.items():
+                    results[directory] = future.result()
+            except BaseException:
+                # Fail fast: drop queued platforms and let in-flight ones finish.
+                for future in futures.values():
+                    future.cancel()
+                raise
+
+        self._check_missing(set(archives) - set(results))
+        reports = [result["report"] for result in results.values() if result["report"]]
+        if reports:
+            self._print_compression_report(reports)
+        self.checksums = {
+            archives[directory]: result["sha256"] for directory, result in results.items()
+        }
+        fingerprints = {
+            directory: result["fingerprint"] for directory, result in results.items()
+        }
+        return self._finish(installer_list, archives, fingerprints, options)
+
+    def _journal_archives(  # pylint: disable=R0913
+        self, directories, results, archives, fingerprints, options
+    ):
+        """Journal each archive as soon as it is built, passing the zip results through."""
+        for directory, result in zip(directories, results):
+            self._record_archive(
+                directory, archives[directory], fingerprints[directory], result[0], options
+            )
+            yield result
+
+    @staticmethod
+    def _record_archive(directory, archive, fingerprint, digest, options):
+        """Journal a built archive with the same fields as its build state entry."""
+        journal.record(
+            "archive",
+            directory,
+            inputs=fingerprint,
+            options=options,
+            sha256=digest,
+            size=os.path.getsize(PATH_TO_BUCKET_FOLDER + archive),
+        )
+
+    def _load_archives(self, mappings_file):
+        """
+        Read agent_list.json
+        :param mappings_file: Path to agent_list.json, or its parsed contents
+        :return: The installer list and a dictionary of {directory: archive}
+        """
+        if isinstance(mappings_file, dict):
+            installer_list = mappings_file
+        else:
+            installer_list = self._parse_mappings(mappings_file)
+        archives = {}
         for os_type in OS_LIST:
             for installer in installer_list[os_type]:
-                dirs.add(installer["dir"])
-                file_list.add(installer["file"])
-
-        missing_dirs = dirs - set(dir_list)
+                archives[installer["dir"]] = installer["file"]
+        return installer_list, archives
 
+    @staticmethod
+    def _check_missing(missing_dirs):
+        """Exit if any directory expected by agent_list.json was not staged."""
         if len(missing_dirs) > 0:
             print(
                 f"Missing directories: {missing_dirs} - this is caused by agent_list.json expecting a package to exist. If you modified the scripts this could mean something went wrong. Please report the issue on our github page."
             )
             sys.exit(1)
-        for directory in dirs:
-            self._create_zip_files(directory)
-        hashes_list = self._get_digest(file_list)
-        self._generate_manifest(installer_list, hashes_list)
-        file_list.add("manifest.json")
-        return file_list
+
+    def _finish(self, installer_list, archives, fingerprints, options):
+        """
+        Save the build state and write the manifest once every archive is built
+        :return: The package files in PATH_TO_BUCKET_FOLDER
+        """
+        journal.sync()
+        hashes = self.checksums
+        if self.incremental:
+            # Keep the entries of other packages built from this workspace,
+            # dropping those whose directory is no longer staged.
+            state = {
+                directory: entry
+                for directory, entry in self._load_state().items()
+                if os.path.isdir(directory)
+            }
+            state.update(
+                {
+                    directory: {
+                        "inputs": fingerprints[directory],
+                        "options": options,
+                        "sha256": hashes[archive],
+                        "size": os.path.getsize(PATH_TO_BUCKET_FOLDER + archive),
+                    }
+                    for directory, archive in archives.items()
+                }
+            )
+            self._save_state(state)
+        self._generate_manifest(
+            installer_list,
+            [{archive: digest} for archive, digest in hashes.items()],
+            self.manifest_name,
+        )
+        return set(archives.values()) | {self.manifest_name}
+
+    @staticmethod
+    def _build_archive(directory, archive, entry, options):
+        """
+        Fingerprint a staged directory and zip it unless its previous archive can be reused
+        :param directory: The directory to archive
+        :param archive: The archive file name in PATH_TO_BUCKET_FOLDER
+        :param entry: The directory's incremental build state entry, or None
+        :param options: The archive options, see _archive_options
+        :return: Dictionary with the fingerprint, the bytes and seconds spent
+            hashing the directory, the archive sha256 and the compression
+            report, which is None when the archive was reused
+        """
+        start_time = time.time()
+        fingerprint, hashed_bytes = DistributorPackager._hash_directory(directory)
+        result = {
+            "fingerprint": fingerprint,
+            "hash_bytes": hashed_bytes,
+            "hash_seconds": time.time() - start_time,
+            "report": None,
+        }
+        if DistributorPackager._is_unchanged(entry, fingerprint, options, archive):
+            result["sha256"] = entry["sha256"]
+        else:
+            result["sha256"], result["report"] = DistributorPackager._create_zip_files(
+                directory, **options
+            )
+        return result
+
+    def _archive_options(self):
+        """Return the options that affect the bytes of a built archive."""
+        return {
+            "reproducible": self.reproducible,
+            "compression": self.compression,
+            "compression_level": self.compression_level,
+        }
+
+    @staticmethod
+    def _print_compression_report(reports):
+        """Print the totals of the compression reports from a build."""
+        totals = {key: sum(report[key] for report in reports) for key in reports[0]}
+        print(
+            f"Compressed {totals['entries']} files "
+            f"({totals['stored']} stored, {totals['entries'] - totals['stored']} deflated): "
+            f"{totals['input_bytes']} -> {totals['output_bytes']} bytes, "
+            f"{totals['input_bytes'] - totals['output_bytes']} bytes saved. "
+            f"Took {totals['seconds']:.2f}s, "
+            f"about {totals['seconds_saved']:.2f}s saved by storing incompressible files."
+        )
+
+    @staticmethod
+    def _is_unchanged(entry, fingerprint, options, archive):
+        """Check whether a previously built archive can be reused as is.
+
+        The archive must still have the recorded sha256, as that is the
+        checksum written to the manifest.
+        """
+        if not entry or entry["inputs"] != fingerprint:
+            return False
+        if entry.get("options") != options:
+            return False
+        archive_path = PATH_TO_BUCKET_FOLDER + archive
+        return (
+            os.path.exists(archive_path)
+            and os.path.getsize(archive_path) == entry["size"]
+            and sha256_file(archive_path) == entry["sha256"]
+        )
+
+    @staticmethod
+    def _hash_directory(directory):
+        """
+        Generate a sha256 over the relative paths and contents of a directory
+        :param directory: The directory to fingerprint
+        :return: The hex digest and the number of bytes hashed
+        """
+        digest = hashlib.sha256()
+        hashed_bytes = 0
+        for root, subdirs, file_list in os.walk(directory):
+            subdirs.sort()
+            for file in sorted(file_list):
+                file_path = os.path.join(root, file)
+                digest.update(os.path.relpath(file_path, directory).encode("utf-8"))
+                with open(file_path, "rb") as file_handle:
+                    for chunk in iter(lambda: file_handle.read(HASH_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        hashed_bytes += len(chunk)
+        return digest.hexdigest(), hashed_bytes
+
+    @staticmethod
+    def _load_state():
+        """Load the incremental build state, or an empty state if none exists."""
+        try:
+            with open(BUILD_STATE_FILE, "r", encoding="utf-8") as file_handle:
+                return json.load(file_handle)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _save_state(state):
+        """Persist the incremental build state."""
+        with open(BUILD_STATE_FILE + ".tmp", "w", encoding="utf-8") as file_handle:
+            json.dump(state, file_handle, indent=2, sort_keys=True)
+        os.replace(BUILD_STATE_FILE + ".tmp", BUILD_STATE_FILE)
 
     @classmethod
     def _parse_mappings(cls, filename):
@@ -235,12 +1098,13 @@ class DistributorPackager:  # pylint: disable=R0903
 
     @staticmethod
     def _generate_manifest(
-        zip_distros_meta_list, hashes
+        zip_distros_meta_list, hashes, manifest_name="manifest.json"
     ):  # pylint: disable=R0914, R0912
         """
         Generates the manifest.json file required to create the ssm document
         :param installer_list: List containing key value pairs required to construct the file
         :param hashes: list of dictionary items {filename : sha256hash}
+        :param manifest_name: The manifest file name in PATH_TO_BUCKET_FOLDER
         :return:
         """
         manifest_dict = {}
@@ -282,7 +1146,7 @@ class DistributorPackager:  # pylint: disable=R0903
         try:
             manifest_dict["packages"] = manifest_packages_meta
             obj = {}
-            for hash_val in hashes:
+            for hash_val in sorted(hashes, key=lambda item: sorted(item)):
                 for key, val in hash_val.items():
                     obj.update({key: {"checksums": {"sha256": val}}})
             # print(obj)
@@ -292,41 +1156,313 @@ class DistributorPackager:  # pylint: disable=R0903
             print(f"Exception {err}")
         try:
             with open(
-                (PATH_TO_BUCKET_FOLDER + "manifest.json"), "w", encoding="utf-8"
+                (PATH_TO_BUCKET_FOLDER + manifest_name), "w", encoding="utf-8"
             ) as file:
                 file.write(json.dumps(manifest_dict))
         except (FileNotFoundError, FileExistsError, OSError) as err:
             print(err)
 
     @staticmethod
-    def _create_zip_files(directory):
-        """Create a zip file from the contents of the specified directory."""
-        with zipfile.ZipFile(
-            PATH_TO_BUCKET_FOLDER + directory + ".zip", "w", zipfile.ZIP_DEFLATED
-        ) as zipf:
-            for root, _, file_list in os.walk(directory + "/"):
+    def _create_zip_files(
+        directory, reproducible=False, compression="deflate", compression_level=None
+    ):
+        """
+        Create a zip file from the contents of the specified directory
+        :param directory: The directory to archive
+        :param reproducible: Write sorted entries with fixed timestamps and
+            normalized permissions so identical inputs give identical archives
+        :param compression: One of COMPRESSION_MODES
+        :param compression_level: The deflate level, or None for the zlib default
+        :return: The sha256 of the created archive and a compression report
+        """
+        archive_path = PATH_TO_BUCKET_FOLDER + directory + ".zip"
+        # Write to a temporary name so an interrupted build never leaves a
+        # truncated archive that could be mistaken for a finished one.
+        partial_path = archive_path + ".partial"
+        report = {
+            "entries": 0,
+            "stored": 0,
+            "input_bytes": 0,
+            "output_bytes": 0,
+            "seconds": 0.0,
+            "seconds_saved": 0.0,
+        }
+        start_time = time.time()
+        with zipfile.ZipFile(partial_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+            for root, subdirs, file_list in os.walk(directory + "/"):
+                if reproducible:
+                    subdirs.sort()
+                    file_list.sort()
                 for file in file_list:
                     file_path = os.path.join(root, file)
-                    zipf.write(file_path, basename(file_path))
+                    compress_type, seconds_saved = DistributorPackager._choose_compression(
+                        file_path, compression, compression_level
+                    )
+                    if reproducible:
+                        DistributorPackager._write_reproducible(
+                            zipf,
+                            file_path,
+                            basename(file_path),
+                            compress_type,
+                            compression_level,
+                        )
+                    else:
+                        zipf.write(
+                            file_path,
+                            basename(file_path),
+                            compress_type,
+                            compression_level,
+                        )
+                    zinfo = zipf.infolist()[-1]
+                    report["entries"] += 1
+                    report["stored"] += compress_type == zipfile.ZIP_STORED
+                    report["input_bytes"] += zinfo.file_size
+                    report["output_bytes"] += zinfo.compress_size
+                    report["seconds_saved"] += seconds_saved
+        report["seconds"] = time.time() - start_time
+        # zipfile seeks back to rewrite each local header once an entry is
+        # written, so the digest is taken straight after the archive is closed
+        # while it is still in the page cache.
+        digest = sha256_file(partial_path)
+        os.replace(partial_path, archive_path)
+        return digest, report
 
     @staticmethod
-    def _get_digest(file_list):
+    def _choose_compression(file_path, compression, compression_level):
         """
-        Generate sha256 of hash
-        :param files:
-        :return:
+        Pick the compression method for a single archive entry
+        :param file_path: The file to be archived
+        :param compression: One of COMPRESSION_MODES
+        :param compression_level: The deflate level used for sampling
+        :return: The zipfile compression type and the estimated seconds saved
+            by not deflating the file
         """
-        hashes = []
-        for file in file_list:
-            file_path = PATH_TO_BUCKET_FOLDER + file
-            with open(file_path, "rb") as file_handle:
-                read_bytes = file_handle.read()  # read entire file as bytes
-                readable_hash = hashlib.sha256(read_bytes).hexdigest()
-                hashes.append({file: readable_hash})
-        return hashes
+        if compression == "store":
+            return zipfile.ZIP_STORED, 0.0
+        if compression == "deflate":
+            return zipfile.ZIP_DEFLATED, 0.0
 
+        # Sample the start, middle and end of the file; installers are mostly
+        # already compressed payloads that deflate cannot shrink.
+        file_size = os.path.getsize(file_path)
+        sample = b""
+        with open(file_path, "rb") as file_handle:
+            for offset in (0, file_size // 2, max(file_size - COMPRESSION_SAMPLE_SIZE, 0)):
+                file_handle.seek(offset)
+                sample += file_handle.read(COMPRESSION_SAMPLE_SIZE)
+        if not sample:
+            return zipfile.ZIP_DEFLATED, 0.0
 
-if __name__ == "__main__":
+        start_time = time.time()
+        level = -1 if compression_level is None else compression_level
+        compressed = zlib.compress(sample, level)
+        sample_seconds = time.time() - start_time
+        if len(compressed) / len(sample) < COMPRESSION_STORE_RATIO:
+            return zipfile.ZIP_DEFLATED, 0.0
+        return zipfile.ZIP_STORED, sample_seconds * file_size / len(sample)
+
+    @staticmethod
+    def _write_reproducible(  # pylint: disable=R0913
+        zipf, file_path, arcname, compress_type=zipfile.ZIP_DEFLATED, compresslevel=None
+    ):
+        """Add a file to an archive without any host specific metadata.
+
+        The file is streamed into the archive in HASH_CHUNK_SIZE chunks, so
+        memory use does not grow with the installer size.
+        """
+        zinfo = zipfile.ZipInfo(arcname, date_time=REPRODUCIBLE_DATE_TIME)
+        zinfo.create_system = 3
+        mode = 0o755 if os.access(file_path, os.X_OK) else 0o644
+        zinfo.external_attr = (0o100000 | mode) << 16
+        zinfo.compress_type = compress_type
+        # Lets the writer decide up front whether the entry needs zip64
+        zinfo.file_size = os.path.getsize(file_path)
+        if compresslevel is not None:
+            if hasattr(zinfo, "compress_level"):  # Python 3.13+
+                zinfo.compress_level = compresslevel
+            else:
+                zinfo._compresslevel = compresslevel  # pylint: disable=W0212
+        with open(file_path, "rb") as src, zipf.open(zinfo, "w") as dest:
+            shutil.copyfileobj(src, dest, HASH_CHUNK_SIZE)
+
+
+def replicate_package(  # pylint: disable=R0913
+    source, source_bucket, regions, file_list, checksums, workers=1, **updater_args
+):
+    """
+    Replicate the package files into a bucket in each region with server side copies
+    :param source: The S3BucketUpdater the files were uploaded with
+    :param source_bucket: The bucket the files were uploaded to
+    :param regions: Regions to replicate to; each gets the bucket <source_bucket>-<region>
+    :param file_list: Files in PATH_TO_BUCKET_FOLDER to replicate
+    :param checksums: Dictionary of {filename: sha256}
+    :param workers: The maximum number of regions replicated at once
+    :param updater_args: Keyword arguments for each region's S3BucketUpdater
+    :return: Dictionary of {region: bucket} for the regions that were replicated
+    """
+
+    def replicate(region):
+        bucket = f"{source_bucket}-{region}"
+        try:
+            S3BucketUpdater(region, **updater_args).replicate(
+                source, source_bucket, bucket, file_list, "falcon/", checksums
+            )
+        except (BotoCoreError, ClientError) as err:
+            print(f"Replication error in {region}: {err}")
+            return None
+        return bucket
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        buckets = dict(zip(regions, executor.map(replicate, regions)))
+    return {region: bucket for region, bucket in buckets.items() if bucket}
+
+
+def publish_package(package, buckets, manifest_path, workers=1, keep_versions=None):
+    """
+    Publish the Distributor package to several regions concurrently
+    :param package: The name of the distributor package
+    :param buckets: Dictionary of {region: bucket} to publish to
+    :param manifest_path: Path to the manifest.json to publish
+    :param workers: The maximum number of regions published at once
+    :param keep_versions: Prune all but the default and this many newest
+        document versions before publishing
+    :return: Dictionary of {region: (status, error)}
+    """
+
+    manifest_sha = sha256_file(manifest_path)
+
+    def publish(region):
+        if journal.completed("publish", f"{region}/{package}", manifest_sha):
+            print(f"Resuming: distributor package was already published in {region}")
+            return "resumed", ""
+        print(f"Creating distributor package in {region}")
+        with instrumentation.span("ssm_publish", region=region) as span:
+            span["bytes"] = os.path.getsize(manifest_path)
+            try:
+                status = SSMPackageUpdater(region, keep_versions).update(
+                    package, manifest_path, buckets[region]
+                )
+            except (BotoCoreError, ClientError) as err:
+                span["status"] = "failed"
+                return "failed", str(err)
+            span["status"] = status
+        journal.record("publish", f"{region}/{package}", sha256=manifest_sha)
+        return status, ""
+
+    from tabulate import tabulate  # pylint: disable=C0415
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = dict(zip(buckets, executor.map(publish, buckets)))
+    journal.sync()
+    print(
+        tabulate(
+            [[region, status, error] for region, (status, error) in results.items()],
+            headers=["Region", "Status", "Error"],
+        )
+    )
+    return results
+
+
+def distribute(  # pylint: disable=R0913
+    bucket_updater,
+    s3bucket,
+    regions,
+    package_name,
+    files,
+    checksums,
+    replicate=False,
+    region_workers=1,
+    keep_versions=None,
+    manifest_name="manifest.json",
+    **updater_args,
+):
+    """
+    Replicate and publish a package whose files were uploaded to the first region
+    :param bucket_updater: The S3BucketUpdater the package files were uploaded with
+    :param s3bucket: The bucket the package files were uploaded to
+    :param regions: Regions to publish to, starting with the region of s3bucket
+    :param package_name: The name of the distributor package, or None to skip publishing
+    :param files: The package files in PATH_TO_BUCKET_FOLDER
+    :param checksums: Dictionary of {filename: sha256}
+    :param replicate: Copy the package files to a bucket in every additional region
+    :param region_workers: The maximum number of regions replicated or published at once
+    :param keep_versions: See publish_package
+    :param manifest_name: The package's manifest file in PATH_TO_BUCKET_FOLDER
+    :param updater_args: Keyword arguments for each replica region's S3BucketUpdater
+    :return: The regions the package could not be published to
+    """
+    buckets = {region: s3bucket for region in regions}
+    failed_regions = []
+    if replicate and len(regions) > 1:
+        replicas = replicate_package(
+            bucket_updater,
+            s3bucket,
+            regions[1:],
+            files,
+            checksums,
+            workers=region_workers,
+            **updater_args,
+        )
+        failed_regions = [region for region in regions[1:] if region not in replicas]
+        buckets = {regions[0]: s3bucket}
+        buckets.update(replicas)
+
+    if package_name is not None:
+        results = publish_package(
+            package_name,
+            buckets,
+            PATH_TO_BUCKET_FOLDER + manifest_name,
+            workers=region_workers,
+            keep_versions=keep_versions,
+        )
+        failed_regions += [
+            region for region, (status, _) in results.items() if status == "failed"
+        ]
+        if not failed_regions:
+            print("Distributor package has been built successfully.")
+
+    # loop over PATH_TO_BUCKET_FOLDER and upload all files to S3 that are not
+    # in files list. An incremental workspace also holds the archives and
+    # manifests of other packages, and a crashed build may have left partial
+    # archives behind; neither are supporting files.
+    supporting_files = []
+    for file in os.listdir(PATH_TO_BUCKET_FOLDER):
+        if file not in files and not PACKAGE_FILE.fullmatch(file):
+            supporting_files.append(file)
+
+    if len(supporting_files) > 0:
+        bucket_updater.update(s3bucket, supporting_files)
+    return failed_regions
+
+
+def non_negative_int(value):
+    """Parse a command line count that must not be negative."""
+    try:
+        number = int(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}") from err
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative: {number}")
+    return number
+
+
+def positive_int(value):
+    """Parse a command line count that must be at least 1."""
+    try:
+        number = int(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}") from err
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {number}")
+    return number
+
+
+def parse_command_line(argv=None):
+    """
+    Parse the command line for inbound configuration parameters
+    :param argv: Arguments to parse instead of sys.argv
+    :return: The parsed arguments
+    """
     parser = argparse.ArgumentParser(
         description="Create and upload Distributor packages to the AWS SSM"
     )
@@ -346,17 +1482,185 @@ if __name__ == "__main__":
         "--s3bucket",
         help="The name of the s3 bucket to upload the required files to.",
     )
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def add_arguments(parser):
+    """
+    Add the build, upload and publish options shared with create-package.py
+    :param parser: The argparse.ArgumentParser to add the options to
+    """
+    parser.add_argument(
+        "--zip_workers",
+        type=int,
+        help="The number of processes used to build the package zip files.",
+        default=1,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep the build workspace between runs and only rebuild changed platform archives.",
+    )
+    parser.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Build bit-identical archives from identical inputs.",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSION_MODES,
+        help="How archive entries are compressed. auto stores files that do not compress.",
+        default="deflate",
+    )
+    parser.add_argument(
+        "--compression_level",
+        type=int,
+        choices=range(10),
+        help="The deflate compression level (0-9). Defaults to the zlib default.",
+    )
+    parser.add_argument(
+        "--multipart_upload",
+        action="store_true",
+        help="Upload files concurrently using managed multipart transfers.",
+    )
+    parser.add_argument(
+        "--upload_workers",
+        type=positive_int,
+        help="The number of files uploaded concurrently with --multipart_upload.",
+        default=4,
+    )
+    parser.add_argument(
+        "--part_size",
+        type=positive_int,
+        help="The multipart upload part size in MB.",
+        default=8,
+    )
+    parser.add_argument(
+        "--part_workers",
+        type=positive_int,
+        help="The number of parts of a single file uploaded concurrently.",
+        default=10,
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only upload files whose sha256 differs from the object already in the bucket.",
+    )
+    parser.add_argument(
+        "--region_workers",
+        type=positive_int,
+        help="The number of regions the distributor package is published to concurrently.",
+        default=1,
+    )
+    parser.add_argument(
+        "--replicate",
+        action="store_true",
+        help="Copy the package files to a <s3bucket>-<region> bucket in every additional region.",
+    )
+    parser.add_argument(
+        "--keep_versions",
+        type=non_negative_int,
+        help="Before publishing, delete all but the default and this many newest document versions.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run, skipping work its journal records as completed.",
+    )
+    parser.add_argument(
+        "--metrics_dir",
+        help="Write per-stage timings as metrics.jsonl and a Prometheus textfile to this directory.",
+    )
+    parser.add_argument(
+        "--profile_stage",
+        choices=instrumentation.STAGES,
+        help="Profile a single stage, writing the profile to --metrics_dir or the working directory.",
+    )
+    parser.add_argument(
+        "--profile_kind",
+        choices=instrumentation.PROFILE_KINDS,
+        help="The profiler used with --profile_stage.",
+        default="cprofile",
+    )
+
+
+def updater_args(args):
+    """Return the S3BucketUpdater keyword arguments for the parsed command line."""
+    return {
+        "multipart": args.multipart_upload,
+        "upload_workers": args.upload_workers,
+        "part_size": args.part_size * MB,
+        "part_workers": args.part_workers,
+        "sync": args.sync,
+    }
 
-    args = parser.parse_args()
 
+def create_packager(args):
+    """Return the DistributorPackager for the parsed command line."""
+    return DistributorPackager(
+        zip_workers=args.zip_workers,
+        incremental=args.incremental,
+        reproducible=args.reproducible,
+        compression=args.compression,
+        compression_level=args.compression_level,
+    )
+
+
+def publish_build(args, bucket_updater, packager, files):
+    """
+    Replicate and publish a build whose files were uploaded to the first region,
+    then clean up the workspace
+    :param args: The parsed command line
+    :param bucket_updater: The S3BucketUpdater the package files were uploaded with
+    :param packager: The DistributorPackager that built the package
+    :param files: The package files
+    :return: The regions the package could not be published to
+    """
+    failed_regions = distribute(
+        bucket_updater,
+        args.s3bucket,
+        args.aws_regions.split(","),
+        args.package_name,
+        files,
+        packager.checksums,
+        replicate=args.replicate,
+        region_workers=args.region_workers,
+        keep_versions=args.keep_versions,
+        manifest_name=packager.manifest_name,
+        **updater_args(args),
+    )
+
+    if not failed_regions:
+        # Otherwise keep the workspace and journal so the run can be continued with --resume
+        clean_workspace(args)
+    return failed_regions
+
+
+def clean_workspace(args):
+    """Remove the build workspace and journal once a build has been published everywhere."""
+    if not args.incremental:
+        print("Cleaning up files...")
+        with instrumentation.span("cleanup", path=PATH_TO_BUCKET_FOLDER):
+            shutil.rmtree(PATH_TO_BUCKET_FOLDER)
+    journal.finish()
+
+
+def build_and_publish(args):
+    """
+    Build, upload and publish the distributor package
+    :param args: The parsed command line, see parse_command_line
+    :return: The regions the package could not be published to
+    """
     regions = args.aws_regions
-    package_name = args.package_name
     s3bucket = args.s3bucket
 
+    journal.start(BUILD_JOURNAL_FILE, args.resume)
     if not os.path.exists(PATH_TO_BUCKET_FOLDER):
         os.makedirs(PATH_TO_BUCKET_FOLDER)
 
-    files = DistributorPackager().build("agent_list.json")
+    packager = create_packager(args)
+    files = packager.build("agent_list.json")
 
     if regions is None or s3bucket is None:
         print(
@@ -366,25 +1670,33 @@ if __name__ == "__main__":
 
     regions = regions.split(",")
 
-    S3BucketUpdater(regions[0]).update(s3bucket, files, "falcon/")
+    bucket_updater = S3BucketUpdater(regions[0], **updater_args(args))
+    bucket_updater.update(s3bucket, files, "falcon/", packager.checksums)
     print("Package file have been built and uploaded successfully.")
 
-    if package_name is not None:
-        for region in regions:
-            print(f"Creating distributor package in {region}")
-            SSMPackageUpdater(region).update(
-                package_name, PATH_TO_BUCKET_FOLDER + "manifest.json"
-            )
-            print("Distributor package has been built successfully.")
+    return publish_build(args, bucket_updater, packager, files)
 
-    # loop over PATH_TO_BUCKET_FOLDER and upload all files to S3 that are not in files list
-    supporting_files = []
-    for file in os.listdir(PATH_TO_BUCKET_FOLDER):
-        if file not in files:
-            supporting_files.append(file)
 
-    if len(supporting_files) > 0:
-        S3BucketUpdater(regions[0]).update(s3bucket, supporting_files)
+def main(argv=None):
+    """
+    Build, upload and publish the distributor package
+    :param argv: Arguments to parse instead of sys.argv
+    :return: The regions the package could not be published to
+    """
+    args = parse_command_line(argv)
+    if args.profile_stage:
+        instrumentation.configure(
+            "packager", args.profile_stage, args.profile_kind, args.metrics_dir
+        )
 
-    print("Cleaning up files...")
-    shutil.rmtree(PATH_TO_BUCKET_FOLDER)
+    failed_regions = build_and_publish(args)
+
+    if args.metrics_dir:
+        instrumentation.write(args.metrics_dir, "packager")
+    return failed_regions
+
+
+if __name__ == "__main__":
+    failed = main()
+    if failed:
+        sys.exit(f"Failed to publish the distributor package to: {', '.join(failed)}")
@@ -0,0 +1,16 @@
+"""Shared fixtures for the packaging script tests."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # pylint: disable=C0413
+
+
+@pytest.fixture(scope="session")
+def create_package():
+    """The create-package.py module."""
+    return benchmark.load_create_package()
@@ -0,0 +1,92 @@
+"""Tests for building the package archives."""
+
+import os
+import zipfile
+
+import pytest
+
+import packager
+
+OPTIONS = {"reproducible": False, "compression": "deflate", "compression_level": None}
+ARCHIVE = packager.PATH_TO_BUCKET_FOLDER + "CS_WINDOWS.zip"
+
+
+@pytest.fixture(name="workspace")
+def fixture_workspace(tmp_path, monkeypatch):
+    """A working directory with one staged platform and an empty s3-bucket."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "CS_WINDOWS").mkdir()
+    (tmp_path / "CS_WINDOWS" / "WindowsSensor.exe").write_bytes(b"sensor" * 1000)
+    (tmp_path / "CS_WINDOWS" / "install.ps1").write_text("Write-Output install\n")
+    (tmp_path / "s3-bucket").mkdir()
+    return tmp_path
+
+
+def build(options=None):
+    """Build the CS_WINDOWS archive and return its build state entry."""
+    options = options or OPTIONS
+    digest, _ = packager.DistributorPackager._create_zip_files("CS_WINDOWS", **options)
+    return {
+        "inputs": packager.DistributorPackager._hash_directory("CS_WINDOWS")[0],
+        "options": options,
+        "sha256": digest,
+        "size": os.path.getsize(ARCHIVE),
+    }
+
+
+def is_unchanged(entry, options=None):
+    """Check whether the CS_WINDOWS archive of entry can be reused."""
+    return packager.DistributorPackager._is_unchanged(
+        entry, entry["inputs"], options or OPTIONS, "CS_WINDOWS.zip"
+    )
+
+
+def test_unchanged_archive_is_reused(workspace):  # pylint: disable=W0613
+    entry = build()
+    assert entry["sha256"] == packager.sha256_file(ARCHIVE)
+    assert is_unchanged(entry)
+    assert not is_unchanged(entry, {**OPTIONS, "compression": "store"})
+
+
+def test_replaced_archive_of_the_same_size_is_rebuilt(workspace):  # pylint: disable=W0613
+    entry = build()
+    with open(ARCHIVE, "r+b") as file_handle:
+        file_handle.seek(-1, os.SEEK_END)
+        last = file_handle.read(1)
+        file_handle.seek(-1, os.SEEK_END)
+        file_handle.write(bytes([last[0] ^ 0xFF]))
+    assert os.path.getsize(ARCHIVE) == entry["size"]
+    assert not is_unchanged(entry)
+
+
+def test_missing_archive_is_rebuilt(workspace):  # pylint: disable=W0613
+    entry = build()
+    os.remove(ARCHIVE)
+    assert not is_unchanged(entry)
+
+
+def test_reproducible_archives_are_identical(workspace):
+    options = {**OPTIONS, "reproducible": True}
+    first = build(options)["sha256"]
+    os.utime(workspace / "CS_WINDOWS" / "install.ps1", (0, 0))
+    assert build(options)["sha256"] == first
+    with zipfile.ZipFile(ARCHIVE) as archive:
+        assert archive.namelist() == ["WindowsSensor.exe", "install.ps1"]
+        assert {info.date_time for info in archive.infolist()} == {(1980, 1, 1, 0, 0, 0)}
+
+
+@pytest.mark.parametrize("reproducible", [False, True])
+def test_compression_level_is_applied(workspace, reproducible):  # pylint: disable=W0613
+    sizes = {}
+    for level in (0, 9):
+        build({**OPTIONS, "reproducible": reproducible, "compression_level": level})
+        sizes[level] = os.path.getsize(ARCHIVE)
+    assert sizes[9] < sizes[0]
+
+
+def test_auto_compression_stores_incompressible_files(workspace):
+    (workspace / "CS_WINDOWS" / "WindowsSensor.exe").write_bytes(os.urandom(256 * 1024))
+    build({**OPTIONS, "compression": "auto"})
+    with zipfile.ZipFile(ARCHIVE) as archive:
+        types = {info.filename: info.compress_type for info in archive.infolist()}
+    assert types == {"WindowsSensor.exe": zipfile.ZIP_STORED, "install.ps1": zipfile.ZIP_DEFLATED}
@@ -0,0 +1,20 @@
+"""Tests for validating the packager command line."""
+
+import pytest
+
+import packager
+
+REQUIRED = ["--aws_regions", "us-east-1", "--s3bucket", "bkt"]
+
+
+@pytest.mark.parametrize("option", ["--upload_workers", "--part_size", "--part_workers", "--region_workers"])
+@pytest.mark.parametrize("value", ["0", "-1", "two"])
+def test_counts_must_be_positive(option, value):
+    with pytest.raises(SystemExit):
+        packager.parse_command_line(REQUIRED + [option, value])
+
+
+def test_keep_versions_may_be_zero():
+    assert packager.parse_command_line(REQUIRED + ["--keep_versions", "0"]).keep_versions == 0
+    with pytest.raises(SystemExit):
+        packager.parse_command_line(REQUIRED + ["--keep_versions", "-1"])
@@ -0,0 +1,40 @@
+"""Tests for distributing a built package."""
+
+import packager
+
+
+class RecordingUpdater:  # pylint: disable=R0903
+    """S3BucketUpdater stand-in recording the supporting files it uploads."""
+
+    def __init__(self):
+        self.uploaded = []
+
+    def update(self, bucket, files, *_):
+        self.uploaded.append((bucket, sorted(files)))
+
+
+def test_only_supporting_files_are_uploaded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bucket_folder = tmp_path / "s3-bucket"
+    bucket_folder.mkdir()
+    for name in (
+        "CS_WINDOWS_0123456789ab.zip",
+        "manifest-Pkg-A.json",
+        # Left over from another package and a crashed build
+        "CS_WINDOWS_ba9876543210.zip",
+        "manifest-Pkg-B.json",
+        "CS_LINUX_ba9876543210.zip.partial",
+        "README.txt",
+    ):
+        (bucket_folder / name).write_text(name)
+    updater = RecordingUpdater()
+    packager.distribute(
+        updater,
+        "bkt",
+        ["us-east-1"],
+        None,
+        {"CS_WINDOWS_0123456789ab.zip", "manifest-Pkg-A.json"},
+        {},
+        manifest_name="manifest-Pkg-A.json",
+    )
+    assert updater.uploaded == [("bkt", ["README.txt"])]
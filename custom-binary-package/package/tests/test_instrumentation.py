@@ -0,0 +1,36 @@
+"""Tests for the per-stage metrics."""
+
+import json
+
+import instrumentation
+
+
+def test_write_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, "_recorder", instrumentation._Recorder())
+    with instrumentation.span("upload", region="us-east-1") as span:
+        span["bytes"] = 100
+    instrumentation.record("zip", 0.5, 200)
+    instrumentation.add_retries("upload", 2)
+    instrumentation.write(str(tmp_path), "packager")
+
+    lines = [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    summaries = {line["stage"]: line for line in lines if line.get("summary")}
+    assert summaries["upload"]["bytes"] == 100 and summaries["upload"]["retries"] == 2
+    assert summaries["zip"]["seconds"] == 0.5
+
+    prom = (tmp_path / "packager.prom").read_text()
+    assert "# TYPE distributor_stage_duration_seconds gauge" in prom
+    for name in ("bytes", "spans", "retries"):
+        assert f"# TYPE distributor_stage_{name}_total counter" in prom
+    assert 'distributor_stage_bytes_total{process="packager",stage="zip"} 200' in prom
+
+
+def test_retries_are_attributed_to_the_open_span(monkeypatch):
+    monkeypatch.setattr(instrumentation, "_recorder", instrumentation._Recorder())
+    with instrumentation.span("upload") as outer:
+        with instrumentation.span("query") as inner:
+            instrumentation.add_retries("query", 2)
+            instrumentation.add_retries("upload")
+    instrumentation.add_retries("upload", 3)
+    assert inner["retries"] == 2 and outer["retries"] == 1
+    assert instrumentation._recorder.totals()["upload"]["retries"] == 4
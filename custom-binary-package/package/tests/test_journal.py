@@ -0,0 +1,57 @@
+"""Tests for the build journal used by --resume."""
+
+import pytest
+
+import journal
+
+
+@pytest.fixture(name="journal_path")
+def fixture_journal_path(tmp_path):
+    """A journal file path; the journal is closed again after each test."""
+    yield str(tmp_path / "journal.jsonl")
+    journal.finish()
+
+
+def reopen(path, resume):
+    """Simulate the process exiting and a new run starting."""
+    journal._file.close()  # pylint: disable=W0212
+    journal._file = None  # pylint: disable=W0212
+    journal.start(path, resume)
+
+
+def test_resume_keeps_completed_work(journal_path):
+    journal.start(journal_path)
+    assert journal.active() and not journal.resuming()
+    journal.record("upload", "s3://bucket/falcon/a.zip", sha256="aaa")
+    reopen(journal_path, resume=True)
+    assert journal.resuming()
+    assert journal.completed("upload", "s3://bucket/falcon/a.zip", "aaa")
+    assert not journal.completed("upload", "s3://bucket/falcon/a.zip", "bbb")
+    assert journal.entries("upload") == {"s3://bucket/falcon/a.zip": {"sha256": "aaa"}}
+
+
+def test_fresh_run_discards_previous_journal(journal_path):
+    journal.start(journal_path)
+    journal.record("download", "CS_WINDOWS/WindowsSensor.exe", sha256="aaa")
+    reopen(journal_path, resume=False)
+    assert journal.get("download", "CS_WINDOWS/WindowsSensor.exe") is None
+
+
+def test_torn_last_line_is_ignored(journal_path):
+    journal.start(journal_path)
+    journal.record("archive", "CS_WINDOWS", sha256="aaa")
+    journal._file.write('{"stage": "archive", "key": "CS_RHEL')  # pylint: disable=W0212
+    reopen(journal_path, resume=True)
+    assert list(journal.entries("archive")) == ["CS_WINDOWS"]
+    journal.record("archive", "CS_RHEL9_x86_64", sha256="bbb")
+    reopen(journal_path, resume=True)
+    assert sorted(journal.entries("archive")) == ["CS_RHEL9_x86_64", "CS_WINDOWS"]
+
+
+def test_finish_removes_journal(journal_path, tmp_path):
+    journal.start(journal_path)
+    journal.record("publish", "us-east-1/Package", sha256="aaa")
+    journal.sync()
+    journal.finish()
+    assert not journal.active() and not journal.resuming()
+    assert not list(tmp_path.iterdir())
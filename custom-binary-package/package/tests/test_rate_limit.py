@@ -0,0 +1,94 @@
+"""Tests for pacing and retrying the CrowdStrike API requests."""
+
+import pytest
+
+
+class FakeClock:
+    """Stands in for the time module; sleeping advances the clock."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ScriptedFalcon:
+    """APIHarness stand-in returning a scripted sequence of responses."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def command(self, **_):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def response(status=200, **headers):
+    """An APIHarness dict response with X-RateLimit headers."""
+    return {
+        "status_code": status,
+        "headers": {f"X-RateLimit-{name}": str(value) for name, value in headers.items()},
+        "body": {"resources": []},
+    }
+
+
+@pytest.fixture(name="clock")
+def fixture_clock(create_package, monkeypatch):
+    """Replace time in create-package.py with a FakeClock and make backoff deterministic."""
+    clock = FakeClock()
+    monkeypatch.setattr(create_package, "time", clock)
+    monkeypatch.setattr(create_package.random, "uniform", lambda low, high: high)
+    return clock
+
+
+def test_requests_are_paced_by_the_rate_limit(create_package, clock):
+    # 60 requests per minute with 1 left: the next goes out at once, then one per second
+    falcon = ScriptedFalcon([response(Limit=60, Remaining=1)] + [response()] * 3)
+    limited = create_package.RateLimitedFalcon(falcon)
+    for _ in range(4):
+        limited.command(action="GetCombinedSensorInstallersByQuery")
+    assert falcon.calls == 4
+    assert clock.sleeps == pytest.approx([1.0, 1.0])
+
+
+def test_throttled_request_waits_for_retry_after(create_package, clock):
+    falcon = ScriptedFalcon(
+        [response(429, RetryAfter=int(clock.now) + 10), response(200)]
+    )
+    limited = create_package.RateLimitedFalcon(falcon)
+    assert limited.command(action="GetCombinedSensorInstallersByQuery")["status_code"] == 200
+    assert falcon.calls == 2
+    assert clock.sleeps == pytest.approx([10.0])
+
+
+def test_failed_requests_back_off_exponentially(create_package, clock):
+    falcon = ScriptedFalcon([response(503), response(502), response(200)])
+    limited = create_package.RateLimitedFalcon(falcon)
+    assert limited.command(action="GetCombinedSensorInstallersByQuery")["status_code"] == 200
+    assert clock.sleeps == pytest.approx([1.0, 2.0])
+
+
+def test_retries_are_capped(create_package, clock):
+    falcon = ScriptedFalcon([response(500)] * 3)
+    limited = create_package.RateLimitedFalcon(falcon, max_retries=2)
+    assert limited.command(action="GetCombinedSensorInstallersByQuery")["status_code"] == 500
+    assert falcon.calls == 3
+    assert len(clock.sleeps) == 2
+
+
+def test_client_errors_are_not_retried(create_package, clock):
+    falcon = ScriptedFalcon([response(404)])
+    limited = create_package.RateLimitedFalcon(falcon)
+    assert limited.command(action="GetCombinedSensorInstallersByQuery")["status_code"] == 404
+    assert falcon.calls == 1
+    assert not clock.sleeps
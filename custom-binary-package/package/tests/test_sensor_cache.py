@@ -0,0 +1,39 @@
+"""Tests for the content-addressed sensor installer cache."""
+
+import hashlib
+import os
+
+
+def sha256(data):
+    """The hex sha256 of data."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_hit_places_installer(create_package, tmp_path):
+    cache = create_package.SensorCache(str(tmp_path / "cache"), 1024)
+    installer = tmp_path / "falcon-sensor.rpm"
+    installer.write_bytes(b"sensor")
+    cache.store(sha256(b"sensor"), str(installer))
+    staged = tmp_path / "staged.rpm"
+    assert cache.fetch(sha256(b"sensor"), str(staged))
+    assert staged.read_bytes() == b"sensor"
+    assert not cache.fetch(sha256(b"other"), str(tmp_path / "other.rpm"))
+
+
+def test_corrupt_entry_is_evicted(create_package, tmp_path):
+    cache = create_package.SensorCache(str(tmp_path / "cache"), 1024)
+    (tmp_path / "cache" / sha256(b"sensor")).write_bytes(b"sens")
+    staged = tmp_path / "staged.rpm"
+    assert not cache.fetch(sha256(b"sensor"), str(staged))
+    assert not staged.exists()
+    assert not os.listdir(tmp_path / "cache")
+
+
+def test_least_recently_used_entries_are_evicted(create_package, tmp_path):
+    cache = create_package.SensorCache(str(tmp_path / "cache"), 11)
+    for index, data in enumerate((b"first", b"second", b"third")):
+        installer = tmp_path / f"{index}.rpm"
+        installer.write_bytes(data)
+        os.utime(installer, (index, index))
+        cache.store(sha256(data), str(installer))
+    assert sorted(os.listdir(tmp_path / "cache")) == sorted([sha256(b"second"), sha256(b"third")])
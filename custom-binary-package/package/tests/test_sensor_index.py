@@ -0,0 +1,100 @@
+"""Tests for resolving binary_list filters against the cached catalogue."""
+
+import json
+
+import pytest
+
+import benchmark
+
+CATALOGUE = [
+    {"os": "Amazon Linux", "os_version": "2", "platform": "linux", "version": "7.11", "sha256": "a2-new"},
+    {"os": "Amazon Linux", "os_version": "2 - arm64", "platform": "linux", "version": "7.11", "sha256": "a2arm-new"},
+    {"os": "RHEL/CentOS/Oracle", "os_version": "8", "platform": "linux", "version": "7.11", "sha256": "el8-new"},
+    {"os": "Ubuntu", "os_version": "16/18/20/22", "platform": "linux", "version": "7.11", "sha256": "ubuntu-new"},
+    {"os": "Ubuntu", "os_version": "18/20/22 - arm64", "platform": "linux", "version": "7.11", "sha256": "ubuntu-arm"},
+    {"os": "Ubuntu", "os_version": "16/18/20/22 - zLinux", "platform": "linux", "version": "7.11", "sha256": "ubuntu-z"},
+    {"os": "Amazon Linux", "os_version": "2", "platform": "linux", "version": "7.10", "sha256": "a2-old"},
+    {"os": "RHEL/CentOS/Oracle", "os_version": "8", "platform": "linux", "version": "7.10", "sha256": "el8-old"},
+    {"os": "Windows", "os_version": "", "platform": "windows", "version": "7.10", "sha256": "win-old"},
+]
+
+
+@pytest.fixture(name="index")
+def fixture_index(create_package):
+    """A SensorIndex over CATALOGUE."""
+    return create_package.SensorIndex(CATALOGUE)
+
+
+def shas(sensors):
+    """The sha256 of each resolved sensor, in order."""
+    return [sensor["sha256"] for sensor in sensors]
+
+
+def test_exact_terms_keep_version_order(index):
+    assert shas(index.resolve("os:'Amazon Linux'+os_version:'2'+platform:'linux'")) == [
+        "a2-new",
+        "a2-old",
+    ]
+
+
+def test_exact_terms_are_case_insensitive(index):
+    assert shas(index.resolve("os:'windows'+platform:'WINDOWS'")) == ["win-old"]
+
+
+def test_wildcard_terms(index):
+    assert shas(index.resolve("os:'*CentOS*'+os_version:'8'+platform:'linux'")) == [
+        "el8-new",
+        "el8-old",
+    ]
+
+
+def test_negated_and_contains_terms(index):
+    fql = "os:'*Ubuntu*'+os_version:'*16/18/20/22*'+os_version:!'*arm64*'+os_version:!~'zLinux'+platform:'linux'"
+    assert shas(index.resolve(fql)) == ["ubuntu-new"]
+    fql = "os:'*Ubuntu*'+os_version:'*18/20/22*'+os_version:~'arm64'+platform:'linux'"
+    assert shas(index.resolve(fql)) == ["ubuntu-arm"]
+
+
+def test_no_match(index):
+    assert index.resolve("os:'Amazon Linux'+os_version:'2023'+platform:'linux'") == []
+
+
+def test_matches_per_filter_queries(create_package, tmp_path):
+    payloads = benchmark.generate_payloads(create_package.binary_list, 0, str(tmp_path))
+    falcon = benchmark.StubFalcon(
+        create_package.FQL_TERM, create_package.binary_list, payloads, 0
+    )
+    index = create_package.SensorIndex(falcon.catalogue)
+    for binary in create_package.binary_list:
+        assert shas(index.resolve(binary["filter"])) == shas(falcon.by_filter[binary["filter"]])
+
+
+
+@pytest.mark.parametrize(
+    "sensor_version, expected",
+    [("n", "a2-new"), ("N-1", "a2-old"), ("n-5", "a2-old"), ("7.10", "a2-old"), ("7.11", "a2-new")],
+)
+def test_select_sensor(index, create_package, sensor_version, expected):
+    resources = index.resolve("os:'Amazon Linux'+os_version:'2'+platform:'linux'")
+    assert create_package.select_sensor(resources, sensor_version)["sha256"] == expected
+
+
+def test_select_sensor_without_a_matching_version(index, create_package):
+    resources = index.resolve("os:'Amazon Linux'+os_version:'2'+platform:'linux'")
+    assert create_package.select_sensor(resources, "6.") is None
+
+
+@pytest.mark.parametrize(
+    "definitions",
+    [
+        [],
+        {"package_name": "Pkg-A"},
+        [{"sensor_version": "n"}],
+        [{"package_name": "Pkg-A"}, {"package_name": "Pkg-A", "sensor_version": "n-2"}],
+    ],
+)
+def test_invalid_package_definitions(create_package, tmp_path, definitions):
+    path = tmp_path / "packages.json"
+    path.write_text(json.dumps(definitions))
+    with pytest.raises(SystemExit):
+        create_package.load_package_definitions(str(path))
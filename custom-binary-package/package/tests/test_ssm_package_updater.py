@@ -0,0 +1,69 @@
+"""Tests for publishing the distributor package document."""
+
+import json
+
+import benchmark
+import packager
+
+MANIFEST = {"schemaVersion": "2.0", "version": "1.0", "packages": {}, "files": {}}
+
+
+def publish(ssm, tmp_path, bucket, manifest=None):
+    """Publish a manifest through an SSMPackageUpdater backed by ssm."""
+    manifest_path = tmp_path / "manifest.json"
+    manifest_path.write_text(json.dumps(manifest or MANIFEST), encoding="utf-8")
+    updater = packager.SSMPackageUpdater("us-east-1")
+    updater.__dict__["_client"] = ssm
+    return updater.update("Package", str(manifest_path), bucket)
+
+
+def test_doc_matches_ignores_formatting():
+    current = {"Content": json.dumps(MANIFEST, indent=2)}
+    assert packager.SSMPackageUpdater._doc_matches(current, json.dumps(MANIFEST))
+    assert not packager.SSMPackageUpdater._doc_matches(current, json.dumps({**MANIFEST, "version": "2"}))
+    assert not packager.SSMPackageUpdater._doc_matches({"Content": "not json"}, json.dumps(MANIFEST))
+
+
+def test_identical_document_is_unchanged(tmp_path):
+    ssm = benchmark.FakeSSM(0)
+    assert publish(ssm, tmp_path, "bucket") == "created"
+    assert publish(ssm, tmp_path, "bucket") == "unchanged"
+
+
+def test_new_bucket_updates_document(tmp_path):
+    ssm = benchmark.FakeSSM(0)
+    publish(ssm, tmp_path, "bucket")
+    # Change the manifest too, as the in-memory SSM rejects duplicate content
+    assert publish(ssm, tmp_path, "bucket-us-east-1", {**MANIFEST, "version": "2"}) == "updated"
+    tags = ssm.list_tags_for_resource(ResourceType="Document", ResourceId="Package")["TagList"]
+    assert tags == [
+        {"Key": "SourceUrl", "Value": "https://bucket-us-east-1.s3-us-east-1.amazonaws.com/falcon"}
+    ]
+    assert publish(ssm, tmp_path, "bucket-us-east-1", {**MANIFEST, "version": "2"}) == "unchanged"
+
+
+def source_tags(ssm):
+    """The tags of the published document."""
+    return ssm.list_tags_for_resource(ResourceType="Document", ResourceId="Package")["TagList"]
+
+
+def test_untagged_identical_document_is_tagged(tmp_path):
+    ssm = benchmark.FakeSSM(0)
+    # Published before the SourceUrl tag was written
+    ssm.create_document(Name="Package", Content=json.dumps(MANIFEST))
+    assert publish(ssm, tmp_path, "bucket") == "unchanged"
+    assert source_tags(ssm) == [
+        {"Key": "SourceUrl", "Value": "https://bucket.s3-us-east-1.amazonaws.com/falcon"}
+    ]
+    assert list(ssm.documents["Package"]["versions"]) == ["1"]
+
+
+def test_same_manifest_new_bucket_keeps_previous_source(tmp_path, capsys):
+    ssm = benchmark.FakeSSM(0)
+    publish(ssm, tmp_path, "bucket")
+    assert publish(ssm, tmp_path, "other-bucket") == "unchanged"
+    assert "keeping its attachments from https://bucket." in capsys.readouterr().out
+    assert source_tags(ssm) == [
+        {"Key": "SourceUrl", "Value": "https://bucket.s3-us-east-1.amazonaws.com/falcon"}
+    ]
+    assert list(ssm.documents["Package"]["versions"]) == ["1"]